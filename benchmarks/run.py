@@ -0,0 +1,389 @@
+"""Benchmarks for the hot paths of popular.
+
+Run from the repository root:
+
+    python -m benchmarks.run            # compare against the baseline
+    python -m benchmarks.run --save     # store a new baseline
+    python -m benchmarks.run auth_url   # only run matching benchmarks
+
+Each benchmark reports the best time per call over several repeats of a
+fixed number of calls. Absolute timings vary from machine to machine and
+from run to run, so every run also times a fixed pure Python reference
+workload, and the baseline stores each benchmark's time relative to it.
+A benchmark regresses when its relative time is higher than its stored
+one by more than the threshold, in which case the runner exits with
+status 1.
+"""
+
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from popular import Popular
+from popular.decoding import BACKENDS, get_loads
+from popular.exceptions import SocialError
+from popular.instrument import Instrument
+from popular.providers.facebook import FacebookProvider
+from popular.providers.github import GithubProvider
+from popular.providers.google import GoogleProvider
+from popular.testing import FakeTransport, make_id_token
+from popular.utils import (
+    dict_to_query_string,
+    parse_query_string,
+    uri_to_query_string_params,
+)
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+CONFIG = {
+    'client_id': '1234567890-abcdefghijklmnop.apps.example.com',
+    'client_secret': 'af873927ecb2af873927ecb2',
+    'redirect_uri': 'https://example.com/auth/callback?next=/home',
+}
+
+STATE = 'f3d1c9a0b7e24c8e9d6a5b4c3d2e1f00'
+
+PROVIDERS = OrderedDict([
+    ('github', GithubProvider),
+    ('facebook', FacebookProvider),
+    ('google', GoogleProvider),
+])
+
+
+# Every benchmark is a setup function returning the callable to time.
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, number=1000):
+    """Registers a setup function, whose callable is called number times
+    per repeat.
+    """
+    def register(setup):
+        BENCHMARKS[name] = (setup, number)
+        return setup
+    return register
+
+
+REFERENCE_NUMBER = 10000
+
+
+def reference():
+    """The fixed workload every benchmark is measured relative to."""
+    items = [('key%d' % i, 'value%d' % i) for i in range(20)]
+    return lambda: '&'.join('%s=%s' % item for item in dict(items).items())
+
+
+def auth_url(cls):
+    provider = cls(CONFIG, transport=FakeTransport())
+    return lambda: provider.get_auth_url(state=STATE)
+
+
+def get_user(cls):
+    provider = cls(CONFIG, transport=FakeTransport())
+    return lambda: provider.get_user(uri=CALLBACK, state=STATE)
+
+
+for name, cls in PROVIDERS.items():
+    benchmark('auth_url_%s' % name)(lambda cls=cls: auth_url(cls))
+    benchmark('get_user_%s' % name)(lambda cls=cls: get_user(cls))
+
+
+@benchmark('get_user_github_instrumented')
+def get_user_instrumented():
+    provider = GithubProvider(
+        CONFIG, transport=FakeTransport(), instrument=Instrument(),
+    )
+    return lambda: provider.get_user(uri=CALLBACK, state=STATE)
+
+
+@benchmark('serialize_url')
+def serialize_url():
+    provider = GithubProvider(CONFIG, transport=FakeTransport())
+    params = dict(CONFIG, state=STATE, scope='user:email')
+    url = 'https://github.com/login/oauth/authorize'
+    return lambda: provider.serialize_url(url=url, params=params)
+
+
+@benchmark('dict_to_query_string')
+def query_string():
+    params = dict(CONFIG, state=STATE, scope='public_profile,email')
+    return lambda: dict_to_query_string(params)
+
+
+CALLBACK = 'https://example.com/auth/callback?code=4%2F0AX4XfWh&state=' + STATE
+
+CALLBACK_LARGE = 'https://example.com/cb?code=abc&state=%s&%s' % (
+    STATE, '&'.join('p%d=%s' % (i, 'v' * 16) for i in range(100)),
+)
+
+CALLBACK_ADVERSARIAL = 'https://example.com/cb?code=%s&state=%s' % (
+    '%41' * 20000, '=' * 20000,
+)
+
+
+def rejecting(fn, *args, **kwargs):
+    """Times fn even when it refuses its input."""
+    def call():
+        try:
+            fn(*args, **kwargs)
+        except SocialError:
+            pass
+    return call
+
+
+def stdlib_parse(uri):
+    return dict(parse_qsl(urlsplit(uri).query, keep_blank_values=True))
+
+
+@benchmark('callback_parse')
+def callback_parse():
+    return lambda: uri_to_query_string_params(CALLBACK)
+
+
+@benchmark('callback_parse_stdlib')
+def callback_parse_stdlib():
+    return lambda: stdlib_parse(CALLBACK)
+
+
+@benchmark('callback_parse_required')
+def callback_parse_required():
+    return lambda: parse_query_string(CALLBACK_LARGE, ['code', 'state'])
+
+
+@benchmark('callback_parse_large', number=200)
+def callback_parse_large():
+    return lambda: uri_to_query_string_params(CALLBACK_LARGE)
+
+
+@benchmark('callback_parse_large_stdlib', number=200)
+def callback_parse_large_stdlib():
+    return lambda: stdlib_parse(CALLBACK_LARGE)
+
+
+@benchmark('callback_parse_adversarial')
+def callback_parse_adversarial():
+    return rejecting(uri_to_query_string_params, CALLBACK_ADVERSARIAL)
+
+
+@benchmark('callback_parse_adversarial_stdlib', number=5)
+def callback_parse_adversarial_stdlib():
+    return lambda: stdlib_parse(CALLBACK_ADVERSARIAL)
+
+
+# Profiles the size of what the vendors actually send back.
+GITHUB_USER = {
+    'login': 'dreynolds',
+    'id': 1234567,
+    'node_id': 'MDQ6VXNlcjEyMzQ1Njc=',
+    'avatar_url': 'https://avatars.githubusercontent.com/u/1234567?v=4',
+    'gravatar_id': '',
+    'url': 'https://api.github.com/users/dreynolds',
+    'html_url': 'https://github.com/dreynolds',
+    'followers_url': 'https://api.github.com/users/dreynolds/followers',
+    'following_url':
+        'https://api.github.com/users/dreynolds/following{/other_user}',
+    'gists_url': 'https://api.github.com/users/dreynolds/gists{/gist_id}',
+    'starred_url':
+        'https://api.github.com/users/dreynolds/starred{/owner}{/repo}',
+    'subscriptions_url':
+        'https://api.github.com/users/dreynolds/subscriptions',
+    'organizations_url': 'https://api.github.com/users/dreynolds/orgs',
+    'repos_url': 'https://api.github.com/users/dreynolds/repos',
+    'events_url': 'https://api.github.com/users/dreynolds/events{/privacy}',
+    'received_events_url':
+        'https://api.github.com/users/dreynolds/received_events',
+    'type': 'User',
+    'site_admin': False,
+    'name': 'Dennis Reynolds',
+    'company': 'Paddy\'s Pub',
+    'blog': 'https://example.com',
+    'location': 'Philadelphia, PA',
+    'email': 'dennis@example.com',
+    'hireable': None,
+    'bio': 'The golden god. ' * 8,
+    'twitter_username': None,
+    'public_repos': 42,
+    'public_gists': 7,
+    'followers': 1024,
+    'following': 12,
+    'created_at': '2012-03-14T15:09:26Z',
+    'updated_at': '2017-06-01T12:00:00Z',
+    'private_gists': 3,
+    'total_private_repos': 5,
+    'owned_private_repos': 5,
+    'disk_usage': 102400,
+    'collaborators': 2,
+    'two_factor_authentication': True,
+    'plan': {
+        'name': 'pro',
+        'space': 976562499,
+        'collaborators': 0,
+        'private_repos': 9999,
+    },
+}
+
+GOOGLE_USER = {
+    'sub': '109876543210987654321',
+    'name': 'Dennis Reynolds',
+    'given_name': 'Dennis',
+    'family_name': 'Reynolds',
+    'picture': (
+        'https://lh3.googleusercontent.com/a/'
+        'ACg8ocJ2x7Q4Hk5yVqk3mZ0pT8n1rW6sE9dF2gL0bXcYvA=s96-c'
+    ),
+    'email': 'dennis@example.com',
+    'email_verified': True,
+    'locale': 'en',
+    'hd': 'example.com',
+}
+
+REAL_ROUTES = {
+    'github': {'https://api.github.com/user': GITHUB_USER},
+    'google': {GoogleProvider.PROFILE_URL: GOOGLE_USER},
+}
+
+
+def installed_backends():
+    for name in BACKENDS:
+        try:
+            yield name, get_loads(name)
+        except SocialError:
+            pass
+
+
+def decode(loads, payload):
+    content = json.dumps(payload).encode('utf-8')
+    return lambda: loads(content)
+
+
+def real_get_user(name, **options):
+    cls = PROVIDERS[name]
+    transport = FakeTransport(routes=REAL_ROUTES[name])
+    provider = cls(CONFIG, transport=transport, **options)
+    return lambda: provider.get_user(uri=CALLBACK, state=STATE)
+
+
+for backend, loads in installed_backends():
+    for name, payload in [('github', GITHUB_USER), ('google', GOOGLE_USER)]:
+        benchmark('decode_%s_%s' % (name, backend))(
+            lambda loads=loads, payload=payload: decode(loads, payload)
+        )
+
+for name in REAL_ROUTES:
+    benchmark('get_user_%s_real' % name)(
+        lambda name=name: real_get_user(name)
+    )
+    benchmark('get_user_%s_real_stdlib' % name)(
+        lambda name=name: real_get_user(name, decoder='json')
+    )
+    benchmark('get_user_%s_real_fields' % name)(
+        lambda name=name: real_get_user(name, raw='fields')
+    )
+
+
+@benchmark('get_user_google_openid', number=200)
+def get_user_google_openid():
+    id_token = make_id_token(dict(
+        GOOGLE_USER,
+        iss='https://accounts.google.com',
+        aud=CONFIG['client_id'],
+        iat=0,
+        exp=2 ** 40,
+    ))
+    transport = FakeTransport(routes={
+        GoogleProvider.TOKEN_URL: {
+            'access_token': 'google-token',
+            'expires_in': 3600,
+            'id_token': id_token,
+        },
+    })
+    provider = GoogleProvider(dict(CONFIG, openid='true'), transport=transport)
+    return lambda: provider.get_user(uri=CALLBACK, state=STATE)
+
+
+@benchmark('manager_construction')
+def manager_construction():
+    config = dict((name, dict(CONFIG)) for name in PROVIDERS)
+    transport = FakeTransport()
+    return lambda: Popular(config, transport=transport)
+
+
+@benchmark('manager_first_provider')
+def manager_first_provider():
+    config = dict((name, dict(CONFIG)) for name in PROVIDERS)
+    transport = FakeTransport()
+    return lambda: Popular(config, transport=transport).provider('github')
+
+
+def measure(fn, number, repeat=5):
+    """Returns the best seconds per call of fn."""
+    timer = timeit.Timer(fn)
+    return min(timer.timeit(number) for i in range(repeat)) / number
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('patterns', nargs='*',
+                        help="only run benchmarks containing one of these")
+    parser.add_argument('--save', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="allowed slowdown ratio before failing")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    results = OrderedDict()
+    regressions = []
+    timings = OrderedDict()
+    unit = measure(reference(), REFERENCE_NUMBER)
+    for name, (setup, number) in BENCHMARKS.items():
+        if args.patterns and not any(p in name for p in args.patterns):
+            continue
+        timings[name] = measure(setup(), number)
+        # The reference is timed between benchmarks too, and the best
+        # time kept, so a slow spell of the machine doesn't skew it.
+        unit = min(unit, measure(reference(), REFERENCE_NUMBER))
+
+    print('%-32s %12.2f us' % ('reference', unit * 1e6))
+    for name, seconds in timings.items():
+        results[name] = seconds / unit
+        line = '%-32s %12.2f us %9.2fx ref' % (
+            name, seconds * 1e6, results[name],
+        )
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += '   %5.2fx baseline' % ratio
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += '   REGRESSION'
+        print(line)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline to %s' % args.baseline)
+    elif regressions:
+        print('Regressed beyond %.2fx: %s' % (
+            args.threshold, ', '.join(regressions),
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Fetching the profiles of many stored tokens at once.
+
+This is meant for periodically re-syncing linked accounts, where there
+is no redirect to follow, only access tokens saved from earlier logins.
+"""
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .limits import TokenBucket
+
+
+# The outcome of one item: either the user or the error is set.
+Result = namedtuple('Result', ['key', 'provider', 'user', 'error'])
+
+
+def fetch_users(provider, items, concurrency=10, rates=None):
+    """Fetches the users of many access tokens, yielding as they finish.
+
+    Items are read lazily and at most `concurrency` vendor calls are in
+    flight at once, so any number of items can be streamed through.
+    Providers with a vendor batch endpoint fetch up to their BATCH_SIZE
+    users per call.
+
+    Args:
+        provider: a callable returning a provider for a provider key,
+            like Manager.provider.
+        items: an iterable of (key, provider key, access token) tuples,
+            where the key identifies the account to the caller.
+        concurrency: the max number of vendor calls in flight.
+        rates: a dict of provider keys to the max number of vendor
+            calls per second made to them.
+
+    Yields:
+        A popular.batch.Result for every item, in completion order.
+    """
+    limiters = dict()
+    for provider_key, rate in (rates or dict()).items():
+        limiters[provider_key] = TokenBucket(rate)
+
+    def run(provider_key, chunk):
+        limiter = limiters.get(provider_key)
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            instance = provider(provider_key)
+            tokens = [access_token for _key, access_token in chunk]
+            if len(tokens) == 1:
+                outcomes = [instance.get_user_from_token(tokens[0])]
+            else:
+                outcomes = instance.get_users_from_tokens(tokens)
+        except Exception as err:
+            outcomes = [err] * len(chunk)
+        results = []
+        for (key, _token), outcome in zip(chunk, outcomes):
+            if isinstance(outcome, Exception):
+                results.append(Result(key, provider_key, None, outcome))
+            else:
+                results.append(Result(key, provider_key, outcome, None))
+        return results
+
+    pending = dict()
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def submit(provider_key):
+            chunk = pending.pop(provider_key)
+            in_flight.add(executor.submit(run, provider_key, chunk))
+
+        def drain(until):
+            while len(in_flight) > until:
+                done, _rest = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.discard(future)
+                    for result in future.result():
+                        yield result
+
+        for key, provider_key, access_token in items:
+            chunk = pending.setdefault(provider_key, [])
+            chunk.append((key, access_token))
+            if len(chunk) >= batch_size(provider, provider_key):
+                submit(provider_key)
+                for result in drain(concurrency - 1):
+                    yield result
+        for provider_key in list(pending):
+            submit(provider_key)
+            for result in drain(concurrency - 1):
+                yield result
+        for result in drain(0):
+            yield result
+
+
+def batch_size(provider, provider_key):
+    try:
+        return provider(provider_key).BATCH_SIZE
+    except Exception:
+        # Let the failure surface per item when the chunk is run.
+        return 1
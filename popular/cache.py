@@ -0,0 +1,252 @@
+"""Caches for data fetched from the vendors.
+
+A cache maps string keys to JSON-serializable values that expire after
+a TTL, and counts its hits, misses and evictions so its effectiveness
+can be monitored.
+"""
+
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+from .forks import ProcessLocal
+
+
+class Cache(ProcessLocal):
+    """Base class for caches with a TTL and a bounded size.
+
+    Subclasses guard their entries and counters with a `lock`.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        Args:
+            max_size: the max number of entries kept.
+            ttl: the default number of seconds an entry lives for.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value of a key, or None if missing or expired."""
+        value = self.load(key, time.time())
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Stores a value for ttl seconds, defaulting to the cache's."""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self.store(key, value, expires)
+
+    def add(self, key, value, ttl=None):
+        """Stores a value unless the key already has one, atomically.
+
+        Returns:
+            Whether the value was stored.
+        """
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        return self.insert(key, value, expires, now)
+
+    def stats(self):
+        """Returns a dict of counters for monitoring."""
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+        )
+
+    def load(self, key, now):
+        raise NotImplementedError()
+
+    def store(self, key, value, expires):
+        raise NotImplementedError()
+
+    def insert(self, key, value, expires, now):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class MemoryCache(Cache):
+    """An in-process LRU cache.
+
+    Forked children start with a copy of the entries.
+    """
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, max_size=10000, ttl=300):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.entries = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def load(self, key, now):
+        with self.lock:
+            try:
+                value, expires = self.entries[key]
+            except KeyError:
+                return None
+            if expires <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def store(self, key, value, expires):
+        with self.lock:
+            self.put(key, value, expires)
+
+    def insert(self, key, value, expires, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            self.put(key, value, expires)
+            return True
+
+    def put(self, key, value, expires):
+        # Callers must hold the lock.
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SqliteCache(Cache):
+    """A cache in a local SQLite file, shared by every process using it.
+
+    Values are stored as JSON. Entries are evicted least recently used
+    first once the cache is over its max size. Counting the entries
+    takes a scan of the table, so the size is only checked every
+    hundredth of max_size writes, and the cache can briefly go over by
+    that much. Every process opens its own connection to the file.
+    """
+
+    PROCESS_LOCAL = ('lock', 'db')
+
+    def __init__(self, path, max_size=100000, ttl=300):
+        """
+        Args:
+            path: the file to keep the cache in.
+            max_size: the max number of entries kept.
+            ttl: the default number of seconds an entry lives for.
+        """
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self.check_every = max(1, min(1000, max_size // 100))
+        self.writes = 0
+        self.reset()
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS popular_cache ('
+                'key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)'
+            )
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS popular_cache_used '
+                'ON popular_cache (used)'
+            )
+
+    def reset(self):
+        # SQLite connections must not be used across a fork, so a
+        # parent's connection is left alone rather than closed.
+        super().reset()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=5, check_same_thread=False,
+        )
+
+    def load(self, key, now):
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT value, expires FROM popular_cache WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.db.execute(
+                    'DELETE FROM popular_cache WHERE key = ?', (key,),
+                )
+                return None
+            self.db.execute(
+                'UPDATE popular_cache SET used = ? WHERE key = ?', (now, key),
+            )
+            return json.loads(row[0])
+
+    def store(self, key, value, expires):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO popular_cache VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires, time.time()),
+            )
+            self.evict()
+
+    def insert(self, key, value, expires, now):
+        # The primary key makes the insert atomic, across processes too.
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM popular_cache WHERE key = ? AND expires <= ?',
+                (key, now),
+            )
+            inserted = self.db.execute(
+                'INSERT OR IGNORE INTO popular_cache VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires, now),
+            ).rowcount
+            if inserted:
+                self.evict()
+            return bool(inserted)
+
+    def evict(self):
+        # Callers must hold the lock, in a transaction.
+        self.writes += 1
+        if self.writes % self.check_every:
+            return
+        excess = self.db.execute(
+            'SELECT COUNT(*) FROM popular_cache',
+        ).fetchone()[0] - self.max_size
+        if excess > 0:
+            self.db.execute(
+                'DELETE FROM popular_cache WHERE key IN (SELECT key '
+                'FROM popular_cache ORDER BY used LIMIT ?)', (excess,),
+            )
+            self.evictions += excess
+
+    def delete(self, key):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM popular_cache WHERE key = ?', (key,))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM popular_cache',
+            ).fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,76 @@
+"""Pluggable decoding of the JSON payloads the vendors send.
+
+orjson or ujson are used when installed, falling back to the standard
+library. Every backend is handed the undecoded bytes of a response, so
+the fast ones skip making a str copy of the body first.
+"""
+
+from gettext import gettext as _
+import importlib
+import json
+
+from .exceptions import SocialError
+
+
+# Backends in order of preference when none is asked for.
+BACKENDS = ('orjson', 'ujson', 'json')
+
+
+def stdlib_loads(content):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def get_loads(name=None):
+    """Returns the function a JSON backend decodes bytes with.
+
+    Args:
+        name: one of BACKENDS, or None for the fastest one installed.
+
+    Returns:
+        A callable taking bytes or a str and returning the decoded data.
+
+    Raises:
+        SocialError: The JSON backend %s is not available.
+    """
+    if name is None:
+        global default_loads
+        if default_loads is None:
+            for backend in BACKENDS:
+                try:
+                    default_loads = get_loads(backend)
+                    break
+                except SocialError:
+                    pass
+        return default_loads
+    if name == 'json':
+        return stdlib_loads
+    if name not in BACKENDS:
+        raise SocialError(_("The JSON backend %s is not available.") % name)
+    try:
+        return importlib.import_module(name).loads
+    except ImportError:
+        raise SocialError(_("The JSON backend %s is not available.") % name)
+
+
+# Filled in with the fastest installed backend the first time it's used.
+default_loads = None
+
+
+def loads(content):
+    """Decodes JSON with the fastest backend installed."""
+    return get_loads()(content)
+
+
+def extract(data, fields):
+    """Keeps only some of the top level fields of a decoded payload.
+
+    Args:
+        data: a decoded JSON object.
+        fields: an iterable of the keys to keep.
+
+    Returns:
+        A new dict with the fields that are present.
+    """
+    return {key: data[key] for key in fields if key in data}
@@ -6,3 +6,18 @@ class SocialError(Exception):
 class SocialProviderError(Exception):
     """Raised when a vendor is sending an error."""
     pass
+
+
+class SocialTimeoutError(SocialProviderError):
+    """Raised when a vendor doesn't answer within the deadline."""
+    pass
+
+
+class SocialUnavailableError(SocialProviderError):
+    """Raised without calling a vendor that is known to be failing."""
+    pass
+
+
+class SocialRateLimitError(SocialUnavailableError):
+    """Raised without calling a vendor whose rate limit is used up."""
+    pass
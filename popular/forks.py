@@ -0,0 +1,75 @@
+"""Keeping per-process state out of pickles and forked children.
+
+Connection pools, worker threads, database connections and locks only
+make sense in the process that made them: a pooled socket used by two
+processes mixes up their requests, threads don't survive a fork, and a
+lock some other thread held at the time of the fork is never released
+in the child.
+
+Objects holding such state list it in PROCESS_LOCAL and rebuild it in
+`reset`. It is left out when they are pickled, and rebuilt both when
+they are unpickled and in every child process right after a fork, so a
+Manager can be set up once in a prefork server's master process.
+Connections are only opened again once a child actually uses them.
+
+Before Python 3.7 there is no hook to run after a fork, so objects
+remember the pid they were reset in instead, and reset again when their
+process local state is read from another process.
+"""
+
+import os
+import weakref
+
+
+# Every live object with process local state.
+registered = weakref.WeakSet()
+
+
+def reset_all():
+    """Rebuilds the process local state of every registered object."""
+    for obj in list(registered):
+        obj.reset()
+
+
+def checked_getattribute(self, name):
+    """Resets an object whose process local state is read after a fork.
+    """
+    get = object.__getattribute__
+    if name in get(self, 'PROCESS_LOCAL'):
+        pid = get(self, '__dict__').get('pid')
+        if pid is not None and pid != os.getpid():
+            self.reset()
+    return get(self, name)
+
+
+class ProcessLocal(object):
+    """Mixin for objects with state that is only good in one process.
+
+    Subclasses name the attributes in PROCESS_LOCAL, build them in
+    `reset` and call `self.reset()` from their constructor.
+    """
+
+    PROCESS_LOCAL = ()
+
+    def reset(self):
+        """Builds the process local attributes from scratch."""
+        self.pid = os.getpid()
+        registered.add(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('pid', None)
+        for name in self.PROCESS_LOCAL:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_all)
+else:
+    # Checking every attribute read is slow, so only when it's needed.
+    ProcessLocal.__getattribute__ = checked_getattribute
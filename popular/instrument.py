@@ -0,0 +1,215 @@
+"""Hooks for measuring where the time of a login goes.
+
+A provider given an Instrument reports every phase of its flows (the
+code exchange, the profile fetch, a refresh), every vendor request with
+its duration and response size, and every error it raises. Providers
+without one skip all of it, so instrumentation costs nothing unless it
+is turned on.
+
+The adapters record the events in a prometheus_client registry or as
+OpenTelemetry spans. Both libraries are optional dependencies, only
+imported when their adapter is created.
+"""
+
+from gettext import gettext as _
+from urllib.parse import urlsplit
+
+from .exceptions import SocialError
+
+
+class Instrument(object):
+    """Base class for receiving provider events. It ignores them all.
+
+    Subclasses override only the events they care about.
+    """
+
+    def start(self, provider, phase):
+        """Called when a phase of a flow starts.
+
+        Args:
+            provider: the string name of the provider.
+            phase: the string name of the phase, like 'exchange' or
+                'profile'.
+
+        Returns:
+            Anything, passed back to `end` when the phase is over.
+        """
+        return None
+
+    def end(self, span, error=None):
+        """Called when a phase ends, with the exception if it failed."""
+
+    def request(self, provider, request):
+        """Called right before a popular.transport.Request is sent."""
+
+    def response(self, provider, request, response, seconds):
+        """Called for every response the vendor sends back.
+
+        Args:
+            provider: the string name of the provider.
+            request: the popular.transport.Request that was sent.
+            response: the response to it.
+            seconds: how long the request took.
+        """
+
+    def error(self, provider, error):
+        """Called with every exception a flow of the provider raises."""
+
+
+class PrometheusInstrument(Instrument):
+    """Records provider events as Prometheus metrics.
+
+    Phase and request durations are histograms, errors are counted by
+    exception type and response sizes are summarized, all labelled by
+    provider.
+    """
+
+    def __init__(self, registry=None, prefix='popular'):
+        """
+        Args:
+            registry: a prometheus_client.CollectorRegistry, defaulting
+                to the global one.
+            prefix: the string the metric names start with.
+
+        Raises:
+            SocialError: The prometheus_client package is required for
+                the PrometheusInstrument.
+        """
+        try:
+            import prometheus_client
+        except ImportError:
+            raise SocialError(_(
+                "The prometheus_client package is required for the "
+                "PrometheusInstrument."
+            ))
+        from timeit import default_timer
+
+        self.timer = default_timer
+        options = dict()
+        if registry is not None:
+            options['registry'] = registry
+        self.phases = prometheus_client.Histogram(
+            '%s_phase_seconds' % prefix,
+            'Time spent in each phase of a login.',
+            ['provider', 'phase', 'outcome'],
+            **options
+        )
+        self.requests = prometheus_client.Histogram(
+            '%s_request_seconds' % prefix,
+            'Time spent on each vendor request.',
+            ['provider', 'method', 'url', 'status'],
+            **options
+        )
+        self.sizes = prometheus_client.Summary(
+            '%s_response_bytes' % prefix,
+            'Size of the vendor responses.',
+            ['provider', 'url'],
+            **options
+        )
+        self.errors = prometheus_client.Counter(
+            '%s_errors' % prefix,
+            'Errors raised by the providers, by type.',
+            ['provider', 'type'],
+            **options
+        )
+
+    def start(self, provider, phase):
+        return (provider, phase, self.timer())
+
+    def end(self, span, error=None):
+        provider, phase, started = span
+        outcome = 'ok' if error is None else 'error'
+        self.phases.labels(provider, phase, outcome).observe(
+            self.timer() - started,
+        )
+
+    def response(self, provider, request, response, seconds):
+        self.requests.labels(
+            provider, request.method, request.url, response.status_code,
+        ).observe(seconds)
+        self.sizes.labels(provider, request.url).observe(
+            len(response.content or b''),
+        )
+
+    def error(self, provider, error):
+        self.errors.labels(provider, error.__class__.__name__).inc()
+
+
+class OpenTelemetryInstrument(Instrument):
+    """Records every phase and vendor request as an OpenTelemetry span.
+
+    Phase spans are made current while their phase runs, so they nest
+    under the application's current span and each other, and request
+    spans are children of the phase they were sent in. A flow is always
+    driven from one thread or task, so phases end in the reverse order
+    they started.
+
+    Request spans are made once their response is in, backdated to when
+    they were sent, so concurrent requests don't need their spans kept
+    open across threads.
+    """
+
+    def __init__(self, tracer=None):
+        """
+        Args:
+            tracer: an opentelemetry.trace.Tracer, defaulting to one from
+                the global tracer provider.
+
+        Raises:
+            SocialError: The opentelemetry-api package is required for
+                the OpenTelemetryInstrument.
+        """
+        try:
+            from opentelemetry import context, trace
+        except ImportError:
+            raise SocialError(_(
+                "The opentelemetry-api package is required for the "
+                "OpenTelemetryInstrument."
+            ))
+        import time
+
+        self.context = context
+        self.trace = trace
+        self.clock = time.time_ns
+        self.tracer = tracer or trace.get_tracer('popular')
+
+    def start(self, provider, phase):
+        span = self.tracer.start_span(
+            'popular.%s' % phase,
+            attributes={'popular.provider': provider},
+        )
+        token = self.context.attach(self.trace.set_span_in_context(span))
+        return span, token
+
+    def end(self, span, error=None):
+        span, token = span
+        self.context.detach(token)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end()
+
+    def response(self, provider, request, response, seconds):
+        ended = self.clock()
+        span = self.tracer.start_span(
+            'popular.request',
+            start_time=ended - int(seconds * 1e9),
+            attributes={
+                'popular.provider': provider,
+                'http.method': request.method,
+                'http.url': request.url,
+                'net.peer.name': urlsplit(request.url).hostname or '',
+                'http.status_code': response.status_code,
+                'http.response_content_length': len(response.content or b''),
+            },
+        )
+        if response.status_code >= 400:
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end(end_time=ended)
+
+    def error(self, provider, error):
+        span = self.trace.get_current_span()
+        span.add_event('popular.error', {
+            'popular.provider': provider,
+            'exception.type': error.__class__.__name__,
+        })
@@ -0,0 +1,275 @@
+from gettext import gettext as _
+import threading
+import time
+
+from .exceptions import SocialRateLimitError, SocialUnavailableError
+from .forks import ProcessLocal
+
+
+# Circuit breaker states.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class TokenBucket(ProcessLocal):
+    """Limits how often something happens, allowing short bursts.
+
+    Callers reserve tokens up front and sleep off any deficit outside of
+    the lock, so waiting callers are served in the order they arrived.
+    """
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate: the number of tokens added per second.
+            burst: the max number of tokens saved up. Defaults to rate.
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def reserve(self, n=1):
+        """Takes n tokens, returning the seconds to wait until they exist."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def release(self, n=1):
+        """Gives back tokens that were reserved but not used."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+    def acquire(self, n=1):
+        """Blocks until n tokens are available and takes them.
+
+        Returns:
+            The number of seconds spent waiting.
+        """
+        wait = self.reserve(n)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def get_header(headers, name):
+    """Looks up a header whatever the case of the headers' keys."""
+    value = headers.get(name)
+    if value is None:
+        lowered = name.lower()
+        for key in headers:
+            if key.lower() == lowered:
+                return headers[key]
+    return value
+
+
+class RateLimiter(object):
+    """Keeps calls to a vendor within its rate limits.
+
+    An optional token bucket paces calls locally, and the vendor turning
+    the app away (a 429, or a Retry-After) stops all calls until the
+    vendor's limit resets. Calls fail fast rather than queueing up
+    behind a long wait.
+
+    GitHub's X-RateLimit-Remaining and X-RateLimit-Reset count the calls
+    left to a single user's token, so they only block everyone when they
+    come with a 429.
+    """
+
+    def __init__(self, rate=None, burst=None, max_wait=1):
+        """
+        Args:
+            rate: the max number of calls per second, or None to only
+                follow the vendor's headers.
+            burst: the max number of calls made at once.
+            max_wait: the max seconds a call waits for the bucket before
+                failing instead.
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_wait = max_wait
+        self.blocked_until = 0
+
+    def acquire(self, n=1):
+        """Takes the right to make n calls.
+
+        Returns:
+            The number of seconds to wait before making them.
+
+        Raises:
+            SocialRateLimitError: The vendor's rate limit is used up.
+        """
+        if time.time() < self.blocked_until:
+            raise SocialRateLimitError(_(
+                "The vendor's rate limit is used up."
+            ))
+        if self.bucket is None:
+            return 0
+        wait = self.bucket.reserve(n)
+        if wait > self.max_wait:
+            self.bucket.release(n)
+            raise SocialRateLimitError(_(
+                "The vendor's rate limit is used up."
+            ))
+        return wait
+
+    def update(self, response):
+        """Follows the rate limit headers of a vendor response."""
+        now = time.time()
+        headers = response.headers
+        retry_after = get_header(headers, 'Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            self.blocked_until = max(
+                self.blocked_until, now + int(retry_after),
+            )
+        if response.status_code != 429:
+            return
+        remaining = get_header(headers, 'X-RateLimit-Remaining')
+        reset = get_header(headers, 'X-RateLimit-Reset')
+        if remaining == '0' and reset is not None and reset.isdigit():
+            self.blocked_until = max(self.blocked_until, int(reset))
+
+    def stats(self):
+        return dict(blocked_until=self.blocked_until)
+
+
+class CircuitBreaker(ProcessLocal):
+    """Fails fast while a vendor keeps failing.
+
+    After `failure_threshold` failures in a row the circuit opens and
+    calls fail without reaching the vendor. Once `reset_timeout` seconds
+    have passed, a single trial call is let through: if it succeeds the
+    circuit closes again, otherwise it stays open for another timeout.
+    """
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Raises unless a call may be made right now.
+
+        Returns:
+            Whether the call is the trial of a half-open circuit, which
+            must end in `success`, `failure` or `abandon`.
+
+        Raises:
+            SocialUnavailableError: The vendor is failing, try again
+                later.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN:
+                if time.time() - self.opened_at >= self.reset_timeout:
+                    self.state = HALF_OPEN
+                    return True
+        raise SocialUnavailableError(_(
+            "The vendor is failing, try again later."
+        ))
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def abandon(self):
+        """Gives up on a trial call that was never made.
+
+        The circuit opens again as it was, so the next call is the
+        trial instead.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def stats(self):
+        return dict(state=self.state, failures=self.failures)
+
+
+class Guard(object):
+    """Puts a rate limiter and a circuit breaker in front of a vendor."""
+
+    def __init__(self, limiter=None, breaker=None):
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+
+    def before(self, n=1):
+        """Checks that n calls may be made.
+
+        The rate limit is checked first, so a call it turns away never
+        takes the trial of a half-open circuit.
+
+        Returns:
+            A tuple of the number of seconds to wait before making the
+            calls, and whether they are the circuit's trial. A trial
+            that isn't made after all has to be given up with
+            `abandon`.
+
+        Raises:
+            SocialRateLimitError: The vendor's rate limit is used up.
+            SocialUnavailableError: The vendor is failing, try again
+                later.
+        """
+        wait = self.limiter.acquire(n)
+        try:
+            trial = self.breaker.allow()
+        except SocialUnavailableError:
+            if self.limiter.bucket is not None:
+                self.limiter.bucket.release(n)
+            raise
+        return wait, trial
+
+    def after(self, response):
+        """Records the outcome of a call from its response."""
+        self.limiter.update(response)
+        if response.status_code == 429 or response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def failed(self):
+        """Records a call that never got a response."""
+        self.breaker.failure()
+
+    def abandon(self):
+        """Records that the trial call was never made."""
+        self.breaker.abandon()
+
+    def stats(self):
+        output = self.breaker.stats()
+        output.update(self.limiter.stats())
+        return output
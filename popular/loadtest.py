@@ -0,0 +1,378 @@
+"""Load testing logins end to end against a local mock vendor.
+
+    python -m popular.loadtest github --logins 2000 --concurrency 50 \\
+        --latency 0.02
+
+A mock vendor answering with the canned responses of popular.testing is
+started in its own process, so its work isn't counted against the
+logins, and every vendor URL is rewritten to point at it. Logins then go
+through `Popular(...).provider(name).get_user(...)` like they would in an
+application, over real pooled HTTP connections, either from a pool of
+threads or as tasks on an event loop.
+
+The report has the throughput, the p50 and p99 latency of a login, and
+the CPU time and memory spent on each login.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import asyncio
+import copy
+import json
+import multiprocessing
+import socketserver
+import sys
+import time
+
+from . import Popular
+from .testing import ERROR_BODY, VENDOR_ROUTES
+from .transport import HttpTransport, Request, Transport
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+CONFIG = {
+    'client_id': 'popular',
+    'client_secret': 'popular',
+    'redirect_uri': 'https://example.com/callback',
+}
+
+CALLBACK = 'https://example.com/callback?code=loadtest&state=loadtest'
+
+
+class VendorHandler(BaseHTTPRequestHandler):
+    """Answers requests for `/<vendor host>/<path>` like the vendor would.
+
+    The server's `latency` is waited out before every response.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.answer()
+
+    def answer(self):
+        parts = urlsplit(self.path)
+        url = 'https://%s' % parts.path.lstrip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        data = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        route = self.server.routes.get(url)
+        if route is None:
+            status, body = 404, ERROR_BODY
+        elif callable(route):
+            status, body = 200, route(Request(self.command, url, data=data))
+        else:
+            status, body = 200, route
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class VendorServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Answers every connection from its own thread."""
+
+    daemon_threads = True
+
+
+def serve(pipe, latency):
+    """Runs the mock vendor until the process is terminated."""
+    server = VendorServer(('127.0.0.1', 0), VendorHandler)
+    server.latency = latency
+    server.routes = VENDOR_ROUTES
+    pipe.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_vendor(latency=0):
+    """Starts the mock vendor in a child process.
+
+    Args:
+        latency: the seconds the vendor takes to answer each request.
+
+    Returns:
+        A tuple of the string base URL of the vendor and its
+        multiprocessing.Process, to terminate once done.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=serve, args=(child, latency), daemon=True,
+    )
+    process.start()
+    port = parent.recv()
+    return 'http://127.0.0.1:%d' % port, process
+
+
+def rewrite(request, base):
+    """Returns a copy of a request, sent to the mock vendor instead."""
+    parts = urlsplit(request.url)
+    rewritten = copy.copy(request)
+    rewritten.url = '%s/%s%s' % (base, parts.netloc, parts.path)
+    if parts.query:
+        rewritten.url += '?' + parts.query
+    return rewritten
+
+
+class RewritingTransport(Transport):
+    """Sends every request through another transport, to the mock vendor.
+    """
+
+    def __init__(self, transport, base):
+        """
+        Args:
+            transport: the popular.transport.Transport that sends the
+                rewritten requests.
+            base: the string base URL of the mock vendor.
+        """
+        self.transport = transport
+        self.base = base
+        super().__init__(workers=transport.workers)
+
+    def send(self, request):
+        return self.transport.send(rewrite(request, self.base))
+
+    def close(self):
+        self.transport.close()
+        super().close()
+
+
+class RewritingAsyncTransport(object):
+    """Sends every request through an awaitable transport, to the mock
+    vendor.
+    """
+
+    def __init__(self, transport, base):
+        self.transport = transport
+        self.base = base
+
+    async def send(self, request):
+        return await self.transport.send(rewrite(request, self.base))
+
+    async def send_all(self, batch):
+        return await self.transport.send_all([
+            rewrite(request, self.base) for request in batch
+        ])
+
+    async def close(self):
+        await self.transport.close()
+
+
+def percentile(ordered, fraction):
+    """Returns the value a fraction of a sorted list is at or below."""
+    if not ordered:
+        return 0.0
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def max_rss():
+    """Returns the peak resident memory of this process in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def login_threads(provider, logins, concurrency, loop):
+    """Runs logins from a pool of threads, returning their latencies."""
+    latencies = []
+    failures = []
+
+    def login(_i):
+        started = time.perf_counter()
+        try:
+            provider.get_user(CALLBACK, 'loadtest')
+        except Exception as err:
+            failures.append(err)
+            return
+        latencies.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(login, range(logins)))
+    return latencies, failures
+
+
+def login_async(provider, logins, concurrency, loop):
+    """Runs logins as tasks on an event loop, returning their latencies.
+    """
+    latencies = []
+    failures = []
+
+    async def login(semaphore):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await provider.get_user_async(CALLBACK, 'loadtest')
+            except Exception as err:
+                failures.append(err)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[login(semaphore) for i in range(logins)])
+
+    loop.run_until_complete(main())
+    return latencies, failures
+
+
+MODES = {
+    'threads': login_threads,
+    'async': login_async,
+}
+
+
+def run(name='github', logins=1000, concurrency=10, latency=0,
+        mode='threads', warmup=50, aiohttp=False):
+    """Measures logins through a provider against the mock vendor.
+
+    Args:
+        name: the string name of the provider, one of the vendors the
+            mock knows about.
+        logins: how many logins to time.
+        concurrency: the max number of logins in flight.
+        latency: the seconds the vendor takes to answer each request.
+        mode: 'threads' to log in from a pool of threads, or 'async' to
+            use get_user_async on an event loop.
+        warmup: how many logins to run first, untimed, to fill the
+            connection pools.
+        aiohttp: whether the async mode sends requests with aiohttp
+            rather than the threads of the blocking transport.
+
+    Returns:
+        A dict with the settings and results of the run.
+    """
+    base, vendor = start_vendor(latency)
+    http = HttpTransport(pool_size=concurrency)
+    transport = RewritingTransport(http, base)
+    async_transport = None
+    if aiohttp:
+        from .transport import AiohttpTransport
+
+        async_transport = RewritingAsyncTransport(
+            AiohttpTransport(pool_size=concurrency), base,
+        )
+    manager = Popular(
+        {name: dict(CONFIG)},
+        transport=transport,
+        async_transport=async_transport,
+    )
+    provider = manager.provider(name)
+    login = MODES[mode]
+    # One loop for every async login, since aiohttp sessions are bound
+    # to the loop they were made on.
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    try:
+        login(provider, warmup, concurrency, loop)
+        rss = max_rss()
+        cpu = time.process_time()
+        started = time.perf_counter()
+        latencies, failures = login(provider, logins, concurrency, loop)
+        seconds = time.perf_counter() - started
+        cpu = time.process_time() - cpu
+        peak = max_rss()
+    finally:
+        if async_transport is not None:
+            loop.run_until_complete(async_transport.close())
+        loop.close()
+        executor.shutdown(wait=True)
+        manager.close()
+        vendor.terminate()
+        vendor.join()
+    latencies.sort()
+    return dict(
+        provider=name,
+        mode=mode,
+        concurrency=concurrency,
+        latency=latency,
+        logins=logins,
+        failed=len(failures),
+        error=repr(failures[0]) if failures else None,
+        seconds=seconds,
+        throughput=len(latencies) / seconds if seconds else 0.0,
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+        cpu_per_login=cpu / logins if logins else 0.0,
+        peak_rss=peak,
+        rss_per_login=(peak - rss) / logins if peak and logins else None,
+    )
+
+
+def format_report(report):
+    lines = [
+        '%-16s %s' % ('provider', report['provider']),
+        '%-16s %s' % ('mode', report['mode']),
+        '%-16s %d' % ('concurrency', report['concurrency']),
+        '%-16s %.1f ms' % ('vendor latency', report['latency'] * 1e3),
+        '%-16s %d (%d failed)' % (
+            'logins', report['logins'], report['failed'],
+        ),
+        '%-16s %.1f logins/s' % ('throughput', report['throughput']),
+        '%-16s %.2f ms' % ('latency p50', report['p50'] * 1e3),
+        '%-16s %.2f ms' % ('latency p99', report['p99'] * 1e3),
+        '%-16s %.3f ms' % ('cpu per login', report['cpu_per_login'] * 1e3),
+    ]
+    if report['peak_rss'] is not None:
+        lines.append('%-16s %.1f MB peak, %+.0f bytes per login' % (
+            'memory', report['peak_rss'] / 2 ** 20, report['rss_per_login'],
+        ))
+    if report['error']:
+        lines.append('%-16s %s' % ('first error', report['error']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('provider', nargs='?', default='github',
+                        help="the provider to log in through")
+    parser.add_argument('--logins', type=int, default=1000,
+                        help="how many logins to time")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="the max number of logins in flight")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds the vendor takes to answer")
+    parser.add_argument('--mode', choices=sorted(MODES), default='threads')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help="untimed logins to run first")
+    parser.add_argument('--aiohttp', action='store_true',
+                        help="send async requests with aiohttp")
+    parser.add_argument('--json', action='store_true',
+                        help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(
+        name=args.provider,
+        logins=args.logins,
+        concurrency=args.concurrency,
+        latency=args.latency,
+        mode=args.mode,
+        warmup=args.warmup,
+        aiohttp=args.aiohttp,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,29 +1,33 @@
 from gettext import gettext as _
-import importlib
-import re
-import sys
+import threading
 
-from . import providers
+from . import batch
 from .exceptions import SocialError
+from .forks import ProcessLocal
+from .limits import CircuitBreaker, Guard, RateLimiter
+from .metadata import MetadataCache
+from .providers import exist_msg, registry
+from .transport import ExecutorAsyncTransport, HttpTransport
 
 
-# Helps to ensure that providers are safe module names.
-provider_pattern = re.compile(r'^[a-z][a-z_]+[a-z]$')
-
-
-# Only define error messages once.
-exist_msg = _("The popular provider %s does not exist.")
-
-
-class Manager(object):
+class Manager(ProcessLocal):
     """Manages interactions with providers.
 
     This class is the developer's simplest interface with the social
     providers. It condenses things like credentials and calling
     providers by name.
+
+    Managers can be pickled, and set up once in the master process of a
+    prefork server: their providers are shared with the workers as is,
+    while connection pools, threads and locks are made again in each
+    worker. Options like caches and instruments have to be picklable
+    too for the manager to be.
     """
 
-    def __init__(self, config):
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, config, transport=None, async_transport=None,
+                 rates=None, breaker=None, metadata=None, **options):
         """Sets up the manager with configuration details for providers.
 
         The configuration should be a dict that looks like:
@@ -38,9 +42,29 @@ class Manager(object):
 
         This configuration also determines which providers will be made
         available through the manager, otherwise raising exceptions.
+        Providers are looked up in popular.providers.registry, but they
+        are only imported and validated on their first use.
+
+        Every provider shares the same transport, so connections to the
+        vendors are pooled and kept alive across logins.
 
         Args:
             config: a dict representing all configured social providers.
+            transport: a popular.transport.Transport shared by all of
+                the providers. A default one is made when omitted.
+            async_transport: an awaitable transport shared by all of the
+                providers for get_user_async, like
+                popular.transport.AiohttpTransport.
+            rates: a dict of provider names to the max number of vendor
+                calls per second made to them. Vendor rate limit headers
+                are followed either way.
+            breaker: a dict of popular.limits.CircuitBreaker arguments,
+                like failure_threshold and reset_timeout, used for every
+                provider.
+            metadata: a popular.metadata.MetadataCache shared by all of
+                the providers for the documents the vendors publish. A
+                memory only one is made when omitted.
+            **options: passed on to every provider, like raw='bytes'.
 
         Raises:
             SocialError: The popular provider "%s" does not exist.
@@ -50,25 +74,29 @@ class Manager(object):
             raise ValueError(_(
                 "The popular configuration must be a dict."
             ))
-        self.providers = dict()
         for name in config:
-            if not provider_pattern.match(name):
-                raise SocialError(exist_msg % name)
-            try:
-                module = importlib.import_module(
-                    ".%s" % name, providers.__name__
-                )
-            except ImportError:
+            if name not in registry:
                 raise SocialError(exist_msg % name)
-            try:
-                provider = module.provider
-            except AttributeError:
-                raise SocialError(exist_msg % name)
-            self.providers[name] = provider(config[name])
+        self.config = config
+        self.transport = transport
+        self.async_transport = async_transport
+        self.rates = rates or dict()
+        self.breaker = breaker or dict()
+        self.metadata = metadata if metadata is not None else MetadataCache()
+        self.options = options
+        self.providers = dict()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
 
     def provider(self, name):
         """Returns the provider of choice.
 
+        The provider is imported and set up the first time it is asked
+        for, and reused after that.
+
         Args:
             name: a string name identifying the social provider.
 
@@ -77,8 +105,119 @@ class Manager(object):
 
         Raises:
             SocialError: The popular provider "%s" does not exist.
+            SocialError: The %s provider requires the following
+                keys: %s.
         """
         try:
             return self.providers[name]
         except KeyError:
+            pass
+        if name not in self.config:
             raise SocialError(exist_msg % name)
+        provider = registry.get(name)
+        with self.lock:
+            if name not in self.providers:
+                if self.transport is None:
+                    self.transport = HttpTransport()
+                if self.async_transport is None:
+                    self.async_transport = ExecutorAsyncTransport(
+                        self.transport,
+                    )
+                self.providers[name] = provider(
+                    self.config[name],
+                    transport=self.transport,
+                    async_transport=self.async_transport,
+                    guard=Guard(
+                        RateLimiter(rate=self.rates.get(name)),
+                        CircuitBreaker(**self.breaker),
+                    ),
+                    metadata=self.metadata,
+                    **self.options
+                )
+        return self.providers[name]
+
+    def preload(self, warm=False):
+        """Sets up every configured provider and the transports now.
+
+        Call this before forking workers, so they start out with the
+        providers ready rather than each validating them again.
+
+        Args:
+            warm: whether to also fetch the documents the vendors
+                publish, like discovery documents and signing keys, so
+                no login has to wait on them.
+
+        Raises:
+            SocialError: The %s provider requires the following
+                keys: %s.
+            SocialProviderError: A document could not be fetched.
+        """
+        for name in self.config:
+            provider = self.provider(name)
+            if warm:
+                provider.run(provider.warm())
+
+    async def get_user_async(self, name, uri, state=None, verifier=None):
+        """Retrieves a user from a provider without blocking the loop.
+
+        Args:
+            name: a string name identifying the social provider.
+            uri: a string uri that the service sent the user to,
+                including all query paramters attached.
+            state: a string that was provided for this exact request
+                when the user was first redirected, or None if it was
+                a signed state.
+            verifier: the PKCE code verifier the auth url was made
+                with, if any.
+
+        Returns:
+            A popular.users.User instance.
+
+        Raises:
+            SocialError: The popular provider "%s" does not exist.
+        """
+        return await self.provider(name).get_user_async(
+            uri, state, verifier,
+        )
+
+    def fetch_users(self, items, concurrency=10, rates=None):
+        """Fetches the users of many stored access tokens.
+
+        Args:
+            items: an iterable of (key, provider name, access token)
+                tuples, where the key identifies the account.
+            concurrency: the max number of vendor calls in flight.
+            rates: a dict of provider names to the max number of vendor
+                calls per second made to them.
+
+        Yields:
+            A popular.batch.Result for every item, in completion order.
+        """
+        return batch.fetch_users(
+            self.provider, items, concurrency=concurrency, rates=rates,
+        )
+
+    def health(self):
+        """Reports the rate limit and circuit breaker state of providers.
+
+        Returns:
+            A dict of the names of the providers used so far to dicts
+            with their circuit `state`, consecutive `failures` and the
+            time their rate limit is `blocked_until`.
+        """
+        return {
+            name: provider.guard.stats()
+            for name, provider in list(self.providers.items())
+        }
+
+    def close(self):
+        """Releases the pooled vendor connections."""
+        self.metadata.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    async def close_async(self):
+        """Releases the pooled vendor connections of both transports."""
+        if self.async_transport is not None:
+            await self.async_transport.close()
+        self.close()
@@ -0,0 +1,185 @@
+"""A cache of the documents vendors publish about themselves.
+
+OpenID Connect vendors describe their endpoints in a discovery document
+and publish the keys they sign with as a JWK set. Both rarely change, so
+they are fetched once, on first use, and kept for as long as the vendor's
+Cache-Control max-age allows.
+
+Once a document goes stale it is still served while it is revalidated
+in the background with its ETag, so after warming up no login waits on
+a vendor document. Documents can also be kept in a popular.cache.Cache
+like a SqliteCache, to share them between processes and restarts.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
+import time
+
+from .forks import ProcessLocal
+from .limits import get_header
+from .transport import Request
+
+
+def get_max_age(headers, default):
+    """Returns the seconds a response may be cached for.
+
+    Args:
+        headers: the dict of response headers.
+        default: the seconds to use when there's no max-age.
+    """
+    control = get_header(headers or dict(), 'Cache-Control') or ''
+    found = re.search(r'max-age=(\d+)', control)
+    if found:
+        return int(found.group(1))
+    return default
+
+
+class MetadataCache(ProcessLocal):
+    """Vendor documents, like discovery documents and JWK sets, by URL.
+
+    Entries are dicts with the decoded `data` of a document, its `etag`
+    and when it `expires`. Forked children start with a copy of them.
+    """
+
+    PROCESS_LOCAL = ('lock', 'executor', 'refreshing')
+
+    def __init__(self, store=None, max_age=3600, keep=604800):
+        """
+        Args:
+            store: a popular.cache.Cache the documents are also kept in,
+                like a popular.cache.SqliteCache to keep them on disk.
+            max_age: the seconds a document is fresh for when the vendor
+                doesn't say.
+            keep: the seconds a stale document is still served for while
+                it is being revalidated.
+        """
+        self.store = store
+        self.max_age = max_age
+        self.keep = keep
+        self.entries = dict()
+        self.parsed = dict()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.refreshing = set()
+
+    def get(self, url):
+        """Returns the entry of a document, stale or not, or None.
+
+        Documents stale for longer than `keep` aren't served anymore, so
+        they are fetched again before they are used.
+        """
+        entry = self.entries.get(url)
+        if self.store is not None and (entry is None or self.is_dead(entry)):
+            entry = self.store.get('popular:metadata:%s' % url)
+            if entry is not None:
+                self.entries[url] = entry
+        if entry is not None and self.is_dead(entry):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() < entry['expires']
+
+    def is_dead(self, entry):
+        """Returns whether an entry is too stale to be served at all."""
+        return time.time() >= entry['expires'] + self.keep
+
+    def request(self, url):
+        """Returns the request fetching a document, conditional if cached.
+
+        Args:
+            url: the string URL of the document.
+
+        Returns:
+            A popular.transport.Request.
+        """
+        headers = {'Accept': 'application/json'}
+        entry = self.get(url)
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        return Request('GET', url, headers=headers)
+
+    def load(self, url, response, data=None):
+        """Saves the response to a document request.
+
+        Args:
+            url: the string URL of the document.
+            response: the vendor's response.
+            data: the decoded document, unless the response is a 304
+                saying the cached one is still good.
+
+        Returns:
+            The entry of the document.
+        """
+        entry = self.get(url)
+        if response.status_code != 304 or entry is None:
+            entry = dict(
+                data=data,
+                etag=get_header(response.headers or dict(), 'ETag'),
+            )
+        else:
+            entry = dict(entry)
+        max_age = get_max_age(response.headers, self.max_age)
+        entry['expires'] = time.time() + max_age
+        with self.lock:
+            if self.entries.get(url, entry)['data'] is not entry['data']:
+                self.parsed.pop(url, None)
+            self.entries[url] = entry
+        if self.store is not None:
+            self.store.set(
+                'popular:metadata:%s' % url, entry, ttl=max_age + self.keep,
+            )
+        return entry
+
+    def parse(self, url, entry, parser):
+        """Returns a document turned into something more useful, once.
+
+        Args:
+            url: the string URL of the document.
+            entry: the entry of the document.
+            parser: a callable taking the decoded document. Its result
+                is kept until the document changes.
+        """
+        found = self.parsed.get(url)
+        if found is not None and found[0] is entry['data']:
+            return found[1]
+        result = parser(entry['data'])
+        self.parsed[url] = (entry['data'], result)
+        return result
+
+    def revalidate(self, url, fetch):
+        """Fetches a stale document again in the background.
+
+        Args:
+            url: the string URL of the document.
+            fetch: a callable taking the URL that fetches and loads the
+                document. Its errors are ignored, leaving the stale
+                document in place until the next try.
+        """
+        with self.lock:
+            if url in self.refreshing:
+                return
+            self.refreshing.add(url)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self.refresh, url, fetch)
+
+    def refresh(self, url, fetch):
+        try:
+            fetch(url)
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.discard(url)
+
+    def close(self):
+        """Stops the background revalidation thread."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,124 @@
+"""Local verification of OpenID Connect ID tokens.
+
+An ID token is a JWT the vendor signs with one of the keys it publishes
+as a JWK set. Checking the signature and claims here means the user can
+be built from the token response alone, without asking the vendor for
+the profile.
+
+Only RS256, the algorithm Google signs with, is supported. The RSA
+check is a single modular exponentiation with the public key, so no
+crypto library is needed.
+"""
+
+from gettext import gettext as _
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+
+from .exceptions import SocialProviderError
+
+
+# DER encoding of the SHA-256 AlgorithmIdentifier for PKCS #1 v1.5.
+SHA256_PREFIX = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+def b64decode(text):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+def b64int(text):
+    return int.from_bytes(b64decode(text), 'big')
+
+
+def decode(token):
+    """Splits a JWT into its parts, without checking the signature.
+
+    Returns:
+        A tuple of the decoded header, the decoded claims, the signed
+        bytes and the signature bytes.
+
+    Raises:
+        SocialProviderError: The ID token is malformed.
+    """
+    try:
+        header, payload, signature = token.split('.')
+        return (
+            json.loads(b64decode(header).decode('utf-8')),
+            json.loads(b64decode(payload).decode('utf-8')),
+            ('%s.%s' % (header, payload)).encode('ascii'),
+            b64decode(signature),
+        )
+    except (binascii.Error, ValueError):
+        raise SocialProviderError(_("The ID token is malformed."))
+
+
+def verify_rs256(signed, signature, n, e):
+    """Checks an RSASSA-PKCS1-v1_5 SHA-256 signature.
+
+    Args:
+        signed: the bytes that were signed.
+        signature: the signature bytes.
+        n: the integer modulus of the public key.
+        e: the integer exponent of the public key.
+
+    Returns:
+        Whether the signature is valid.
+    """
+    size = (n.bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+    s = int.from_bytes(signature, 'big')
+    if s >= n:
+        return False
+    encoded = pow(s, e, n).to_bytes(size, 'big')
+    digest = SHA256_PREFIX + hashlib.sha256(signed).digest()
+    padding = size - len(digest) - 3
+    expected = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest
+    return hmac.compare_digest(encoded, expected)
+
+
+def parse_keys(data):
+    """Reads the RSA keys of a JWK set.
+
+    Args:
+        data: the decoded JWK set.
+
+    Returns:
+        A dict of key ids to (modulus, exponent) tuples of integers.
+    """
+    keys = dict()
+    for key in data.get('keys', []):
+        if key.get('kty') == 'RSA':
+            keys[key['kid']] = (b64int(key['n']), b64int(key['e']))
+    return keys
+
+
+def verify_claims(claims, issuers, audience, leeway=60, now=None):
+    """Checks who an ID token is from and for, and that it's current.
+
+    Args:
+        claims: the decoded claims of the token.
+        issuers: the strings the `iss` claim may be.
+        audience: the string client id the token must be for.
+        leeway: the seconds of clock skew allowed.
+        now: the current unix time, for testing.
+
+    Raises:
+        SocialProviderError: The ID token is invalid.
+        SocialProviderError: The ID token has expired.
+    """
+    now = time.time() if now is None else now
+    audiences = claims.get('aud')
+    if isinstance(audiences, str):
+        audiences = [audiences]
+    if claims.get('iss') not in issuers or audience not in (audiences or ()):
+        raise SocialProviderError(_("The ID token is invalid."))
+    if claims.get('exp', 0) + leeway < now:
+        raise SocialProviderError(_("The ID token has expired."))
+    if claims.get('iat', now) - leeway > now:
+        raise SocialProviderError(_("The ID token is invalid."))
@@ -0,0 +1,24 @@
+"""Proof Key for Code Exchange (RFC 7636).
+
+A random verifier is made for every login and only its hash, the
+challenge, goes in the auth url. The vendor then only hands out a token
+for the code to whoever also has the verifier.
+"""
+
+import base64
+import hashlib
+import os
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def make_verifier():
+    """Returns a new random code verifier."""
+    return encode(os.urandom(32))
+
+
+def make_challenge(verifier):
+    """Returns the S256 code challenge of a code verifier."""
+    return encode(hashlib.sha256(verifier.encode('ascii')).digest())
@@ -0,0 +1,160 @@
+"""Registry of the social providers available to the Manager.
+
+Providers are only known by the module path they live in until they are
+first used, so building a Manager never imports a provider (or its
+dependencies) that the application doesn't end up calling.
+
+Third party packages can add providers through the `popular.providers`
+entry point group, pointing either at a Provider subclass, at a provider
+spec (see Provider.from_spec) or at a module with a `provider` attribute:
+
+    entry_points={
+        'popular.providers': [
+            'gitlab = popular_gitlab:GitlabProvider',
+        ],
+    }
+"""
+
+from functools import reduce
+from gettext import gettext as _
+import importlib
+import threading
+
+from ..exceptions import SocialError
+from ..forks import ProcessLocal
+
+
+ENTRY_POINT_GROUP = 'popular.providers'
+
+
+# Only define error messages once.
+exist_msg = _("The popular provider %s does not exist.")
+
+
+def entry_point_targets():
+    """Returns (name, target) pairs of the providers other packages add.
+
+    They're read with importlib.metadata, or with the pkg_resources of
+    setuptools before Python 3.8.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        targets = []
+        for point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+            target = point.module_name
+            if point.attrs:
+                target += ':' + '.'.join(point.attrs)
+            targets.append((point.name, target))
+        return targets
+    found = entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, [])
+    return [(point.name, point.value) for point in found]
+
+
+class Registry(ProcessLocal):
+    """Maps provider names to their classes, importing them on demand."""
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, targets=None):
+        """
+        Args:
+            targets: a dict of provider names to "module" or
+                "module:attribute" strings.
+        """
+        self.targets = dict(targets or dict())
+        self.classes = dict()
+        self.discovered = False
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def register(self, name, target):
+        """Makes a provider available by name.
+
+        Args:
+            name: a string name identifying the social provider.
+            target: a Provider subclass, a provider spec dict, or a
+                "module" or "module:attribute" string to import it from
+                later.
+        """
+        if isinstance(target, dict):
+            from .base import Provider
+
+            target = Provider.from_spec(target)
+        with self.lock:
+            if isinstance(target, str):
+                self.targets[name] = target
+                self.classes.pop(name, None)
+            else:
+                self.classes[name] = target
+
+    def __contains__(self, name):
+        if name in self.classes or name in self.targets:
+            return True
+        self.discover()
+        return name in self.targets
+
+    def discover(self):
+        """Loads third party providers from the entry points, once."""
+        if self.discovered:
+            return
+        with self.lock:
+            if self.discovered:
+                return
+            for name, target in entry_point_targets():
+                self.targets.setdefault(name, target)
+            self.discovered = True
+
+    def get(self, name):
+        """Returns the provider class, importing it on first use.
+
+        Args:
+            name: a string name identifying the social provider.
+
+        Returns:
+            A subclass of popular.providers.base.Provider.
+
+        Raises:
+            SocialError: The popular provider %s does not exist.
+        """
+        try:
+            return self.classes[name]
+        except KeyError:
+            pass
+        if name not in self:
+            raise SocialError(exist_msg % name)
+        module_name, _sep, attribute = self.targets[name].partition(':')
+        try:
+            module = importlib.import_module(module_name)
+            provider = reduce(
+                getattr, (attribute or 'provider').split('.'), module,
+            )
+        except (ImportError, AttributeError):
+            raise SocialError(exist_msg % name)
+        if isinstance(provider, dict):
+            from .base import Provider
+
+            provider = Provider.from_spec(provider)
+        with self.lock:
+            self.classes[name] = provider
+        return provider
+
+
+registry = Registry({
+    'facebook': 'popular.providers.facebook',
+    'github': 'popular.providers.github',
+    'gitlab': 'popular.providers.specs:gitlab',
+    'google': 'popular.providers.google',
+    'microsoft': 'popular.providers.specs:microsoft',
+})
@@ -1,7 +1,24 @@
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from gettext import gettext as _
+from urllib.parse import quote_plus
+import hashlib
+import random
+import time
 
-from ..exceptions import SocialError
-from ..utils import dict_to_query_string, uri_to_query_string_params
+from ..decoding import extract, get_loads
+from ..exceptions import SocialError, SocialProviderError, SocialTimeoutError
+from ..metadata import MetadataCache
+from ..pkce import make_challenge
+from ..tokens import Token
+from ..transport import (
+    ExecutorAsyncTransport,
+    HttpTransport,
+    Request,
+    social_error,
+)
+from ..users import RAW_BYTES, RAW_FIELDS, RAW_KEEP, RAW_MODES, User
+from ..utils import dict_to_query_string, lookup, parse_query_string
 
 
 class Provider(object):
@@ -16,7 +33,68 @@ class Provider(object):
     # the developer know what exactly is required.
     CONFIG_KEYS = []
 
-    def __init__(self, config):
+    # Configuration keys that may be left out, with their defaults. The
+    # seconds to wait on a single vendor call, the seconds a whole login
+    # may take (0 for no limit), how many times a failed idempotent call
+    # is retried and the base seconds of the backoff between retries.
+    # Set pkce to "true" to protect code exchanges with PKCE.
+    OPTIONAL_CONFIG_KEYS = {
+        'timeout': '10',
+        'deadline': '30',
+        'retries': '2',
+        'backoff': '0.1',
+        'pkce': 'false',
+    }
+
+    # Where users are sent to grant permission, without a query string.
+    AUTH_URL = None
+
+    # Where codes and refresh tokens are traded for access tokens.
+    TOKEN_URL = None
+
+    # Where the user of an access token is fetched from.
+    PROFILE_URL = None
+
+    # Where an OpenID Connect vendor publishes its discovery document.
+    # The token and userinfo endpoints it names are used over TOKEN_URL
+    # and PROFILE_URL, which are only fallbacks then.
+    DISCOVERY_URL = None
+
+    # The permissions asked for, joined by SCOPE_SEPARATOR in the auth
+    # url, and any other static auth url parameters.
+    SCOPES = []
+    SCOPE_SEPARATOR = ' '
+    AUTH_PARAMS = {}
+
+    # How the access token is sent to PROFILE_URL, as the scheme of the
+    # Authorization header, with the static query parameters and the
+    # one the vendor selects fields with, if it can.
+    AUTH_SCHEME = 'Bearer'
+    PROFILE_PARAMS = {}
+    FIELDS_PARAM = None
+
+    # Where an error response keeps its message, as dotted paths tried
+    # in order. The first one found is raised.
+    ERROR_PATHS = ('error.message', 'error_description', 'message', 'error')
+
+    # How many users the profiles flow fetches in a single vendor call.
+    BATCH_SIZE = 1
+
+    # The name of the provider, defaulting to the name of its module,
+    # and the spec it was made from, if any.
+    NAME = None
+    SPEC = None
+
+    # Where each user attribute is found in the vendor's profile, as a
+    # dotted path of keys and list indexes. Only the fields needed for
+    # the attributes a provider is set up with are asked for, and they
+    # are all that is kept of the payload with the 'fields' raw mode.
+    USER_FIELDS = {}
+
+    def __init__(self, config, transport=None, async_transport=None,
+                 validate=True, raw=RAW_KEEP, cache=None, guard=None,
+                 instrument=None, decoder=None, signer=None,
+                 attributes=None, metadata=None, replay=None):
         """Does basic validation for the provider.
 
         This doesn't reach out to the actual service to validate
@@ -29,64 +107,1016 @@ class Provider(object):
         Args:
             config: a dict containing credentials for a service provider
                 application.
+            transport: a popular.transport.Transport to send vendor
+                requests through. A private one is made when omitted.
+            async_transport: an awaitable transport like
+                popular.transport.AiohttpTransport used by
+                get_user_async. Defaults to running the transport in
+                the event loop's executor.
+            validate: whether to check the config. Only skip it for a
+                config that has already been checked.
+            raw: how users keep the vendor's original payload. One of
+                popular.users.RAW_KEEP to keep it decoded, RAW_BYTES to
+                keep the undecoded bytes, RAW_FIELDS to keep only the
+                fields it was mapped from or RAW_DROP to discard it.
+                RAW_FIELDS copies the fields out of the decoded payload,
+                so it saves memory but costs a little time.
+            cache: a popular.cache.Cache for the users fetched with an
+                access token, so repeat lookups skip the vendor.
+            guard: a popular.limits.Guard that every vendor call goes
+                through, to rate limit calls and fail fast while the
+                vendor is failing.
+            instrument: a popular.instrument.Instrument told about every
+                phase, vendor request and error, for metrics and tracing.
+            decoder: the JSON backend vendor responses are decoded with,
+                one of popular.decoding.BACKENDS or a callable taking
+                bytes. Defaults to the fastest one installed.
+            signer: a popular.state.StateSigner, which lets auth urls
+                be made and users be fetched without a state of your
+                own, using a signed one instead.
+            attributes: the popular.users.User attributes to fill in,
+                defaulting to all of them. Vendors are only asked for
+                the fields these need. The id is always included.
+            metadata: a popular.metadata.MetadataCache for the documents
+                the vendor publishes, like its JWK set. A private one is
+                made when omitted.
+            replay: a popular.replay.ReplayStore making authorization
+                codes single-use: repeated callbacks share the login in
+                flight, or are rejected once it is done.
 
         Raises:
             SocialError: The %s provider requires the following
                 keys: %s.
+            SocialError: The JSON backend %s is not available.
             TypeError: The "%s" must be a string.
             ValueError: The popular configuration for %s must be a
                 dict.
+            ValueError: The raw option must be one of: %s.
+            ValueError: The attributes must be some of: %s.
+            ValueError: The "%s" must be a number.
         """
         assert self.CONFIG_KEYS
-        self.name = self.__class__.__module__.split('.')[-1]
+        self.name = self.NAME or self.__class__.__module__.split('.')[-1]
+        if validate:
+            self.validate_config(config)
+        if raw not in RAW_MODES:
+            raise ValueError(
+                _("The raw option must be one of: %s.") % ', '.join(RAW_MODES)
+            )
+        self.raw = raw
+        if attributes is None:
+            attributes = User.ATTRIBUTES
+        if not User.ATTRIBUTE_SET.issuperset(attributes):
+            raise ValueError(_("The attributes must be some of: %s.") % (
+                ', '.join(User.ATTRIBUTES),
+            ))
+        self.attributes = frozenset(attributes) | {'id'}
+        self.user_fields = [
+            (attribute, path.split('.'))
+            for attribute, path in self.USER_FIELDS.items()
+            if attribute in self.attributes
+        ]
+        self.fields = tuple(OrderedDict(
+            (path[0], None) for _attribute, path in self.user_fields
+        ))
+        self.selection = self.select_fields()
+        self.profile_params = dict(self.PROFILE_PARAMS)
+        if self.FIELDS_PARAM is not None:
+            self.profile_params[self.FIELDS_PARAM] = self.selection
+        self.cache = cache
+        self.guard = guard
+        self.instrument = instrument
+        self.loads = decoder if callable(decoder) else get_loads(decoder)
+        self.signer = signer
+        self.metadata = metadata if metadata is not None else MetadataCache()
+        self.replay = replay
+        self.config = config
+        self.transport = transport or HttpTransport()
+        self.async_transport = (
+            async_transport or ExecutorAsyncTransport(self.transport)
+        )
+
+    @classmethod
+    def validate_config(cls, config):
+        """Makes sure the config has the keys this provider needs.
+
+        Every key in CONFIG_KEYS is required, and the only others allowed
+        are the ones in OPTIONAL_CONFIG_KEYS.
+
+        Args:
+            config: a dict containing credentials for a service provider
+                application.
+
+        Raises:
+            SocialError: The %s provider requires the following
+                keys: %s.
+            TypeError: The "%s" must be a string.
+            ValueError: The popular configuration for %s must be a
+                dict.
+        """
+        name = cls.NAME or cls.__module__.split('.')[-1]
         if not isinstance(config, dict):
             raise ValueError(_(
                 "The popular configuration for %s must be a dict."
-            ) % self.name)
-        if set(config.keys()) != set(self.CONFIG_KEYS):
+            ) % name)
+        keys = set(config.keys())
+        required = set(cls.CONFIG_KEYS)
+        if not required <= keys or keys - required - set(
+            cls.OPTIONAL_CONFIG_KEYS
+        ):
             raise SocialError(
                 _("The %s provider requires the following keys: %s.") % (
-                    self.name,
-                    ', '.join(self.CONFIG_KEYS),
+                    name,
+                    ', '.join(cls.CONFIG_KEYS),
                 )
             )
-        for name in config:
-            if not isinstance(config[name], str):
-                raise TypeError(_("The \"%s\" must be a string.") % name)
-        self.config = config
+        for key in config:
+            if not isinstance(config[key], str):
+                raise TypeError(_("The \"%s\" must be a string.") % key)
+
+    @classmethod
+    def config_keys(cls):
+        """Returns every key a complete config has, in a stable order."""
+        return cls.CONFIG_KEYS + sorted(cls.OPTIONAL_CONFIG_KEYS)
+
+    @property
+    def config(self):
+        """The credentials of the provider, with defaults filled in.
 
-    def get_auth_url(self, state):
+        Everything but the state is the same for every auth url, so that
+        part is precompiled whenever a config is assigned. Assign a new
+        dict rather than mutating this one to pick up changes.
+        """
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = dict(self.OPTIONAL_CONFIG_KEYS, **config)
+        self.timeout = self.number('timeout', float)
+        self.deadline = self.number('deadline', float)
+        self.retries = self.number('retries', int)
+        self.backoff = self.number('backoff', float)
+        self.pkce = self.flag('pkce')
+        if self.AUTH_URL is not None:
+            self.auth_url_prefix = '%s&state=' % self.serialize_url(
+                url=self.AUTH_URL,
+                params=self.get_auth_params(),
+            )
+
+    def number(self, key, kind):
+        try:
+            return kind(self._config[key])
+        except ValueError:
+            raise ValueError(_("The \"%s\" must be a number.") % key)
+
+    def flag(self, key):
+        return self._config[key].lower() in ('true', 'yes', '1')
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Makes a provider class out of a declarative spec.
+
+        Providers that only need the standard authorization code flow
+        and a single profile request are described entirely by their
+        class attributes, so they can be written down as plain data.
+
+        Args:
+            spec: a dict with a `name` and the lowercased names of the
+                class attributes to set, like `auth_url`, `token_url`,
+                `profile_url`, `scopes` and `user_fields`.
+
+        Returns:
+            A subclass of this provider.
+
+        Raises:
+            ValueError: The provider spec has unknown keys: %s.
+        """
+        attributes = dict(
+            NAME=spec['name'],
+            SPEC=spec,
+            CONFIG_KEYS=['client_id', 'client_secret', 'redirect_uri'],
+            __module__=__name__,
+            __doc__='Provider for %s authentication.' % spec['name'],
+        )
+        unknown = []
+        for key, value in spec.items():
+            if key == 'name':
+                continue
+            if key == 'spec' or not hasattr(cls, key.upper()):
+                unknown.append(key)
+            attributes[key.upper()] = value
+        if unknown:
+            raise ValueError(
+                _("The provider spec has unknown keys: %s.") % (
+                    ', '.join(sorted(unknown)),
+                )
+            )
+        class_name = '%sProvider' % spec['name'].title().replace('_', '')
+        return type(class_name, (cls,), attributes)
+
+    def __reduce_ex__(self, protocol):
+        # Classes made from a spec can't be found by name when unpickled,
+        # so they are made again from the spec.
+        reduced = super().__reduce_ex__(protocol)
+        if self.__class__.__dict__.get('SPEC') is None:
+            return reduced
+        return (spec_provider, (self.SPEC,)) + tuple(reduced[2:])
+
+    def get_auth_params(self):
+        """Returns the static query parameters of the auth url.
+
+        Returns:
+            A dict of every auth url parameter except the state.
+        """
+        params = dict(
+            client_id=self.config['client_id'],
+            redirect_uri=self.config['redirect_uri'],
+            scope=self.SCOPE_SEPARATOR.join(self.SCOPES),
+            response_type='code',
+        )
+        params.update(self.AUTH_PARAMS)
+        return params
+
+    def get_auth_url(self, state=None, redirect=None, verifier=None):
         """Generates the url for the user to grant permission on.
 
         Args:
             state: a string of random characters to help prevent CSRF
-                attacks.
-            state: a string that was provided for this exact request
-                when the user was first redirected.
+                attacks. Leave it out to use a signed state instead.
+            redirect: a string saved in the signed state, like where to
+                send the user after logging in.
+            verifier: a PKCE code verifier from
+                popular.pkce.make_verifier, to keep until the user comes
+                back. With the pkce config set and a signed state, one
+                is derived from the state instead.
 
         Returns:
             A string URL.
+
+        Raises:
+            SocialError: A state is required without a state signer.
+            SocialError: PKCE needs a code verifier or a signed state.
         """
-        raise NotImplementedError()
+        signed = state is None
+        if signed:
+            if self.signer is None:
+                raise SocialError(_(
+                    "A state is required without a state signer."
+                ))
+            state = self.signer.issue(self.name, redirect)
+        url = self.auth_url_prefix + quote_plus(state)
+        if verifier is None and self.pkce:
+            if not signed:
+                raise SocialError(_(
+                    "PKCE needs a code verifier or a signed state."
+                ))
+            verifier = self.signer.make_verifier(state)
+        if verifier is not None:
+            url += '&code_challenge=%s&code_challenge_method=S256' % (
+                make_challenge(verifier),
+            )
+        return url
 
-    def get_user(self, uri, state):
+    def get_user(self, uri, state=None, verifier=None):
         """Takes the response URI and retrieves a user from it.
 
         Args:
             uri: a string uri that the service sent the user to,
                 including all query paramters attached.
             state: a string that was provided for this exact request
-                when the user was first redirected.
+                when the user was first redirected, or None if it was
+                a signed state.
+
+        Returns:
+            A popular.users.User instance.
+
+        Raises:
+            SocialError: The authorization code was already used.
+        """
+        return self.run(
+            self.traced('login', self.login(uri, state, verifier)),
+        )
+
+    async def get_user_async(self, uri, state=None, verifier=None):
+        """Same as get_user, without blocking the event loop.
+
+        Args:
+            uri: a string uri that the service sent the user to,
+                including all query paramters attached.
+            state: a string that was provided for this exact request
+                when the user was first redirected, or None if it was
+                a signed state.
+
+        Returns:
+            A popular.users.User instance.
+
+        Raises:
+            SocialError: The authorization code was already used.
+        """
+        return await self.run_async(
+            self.traced('login', self.login(uri, state, verifier)),
+        )
+
+    def get_user_from_token(self, access_token):
+        """Retrieves the user that an access token belongs to.
+
+        Unlike get_user, this needs no redirect, so a stored token can
+        be used to refresh a known user's profile.
+
+        Args:
+            access_token: a string access token from the vendor.
 
         Returns:
             A popular.users.User instance.
         """
-        raise NotImplementedError()
+        return self.run(self.traced('profile', self.fetch_user(access_token)))
+
+    async def get_user_from_token_async(self, access_token):
+        """Same as get_user_from_token, without blocking the event loop.
+
+        Args:
+            access_token: a string access token from the vendor.
+
+        Returns:
+            A popular.users.User instance.
+        """
+        return await self.run_async(
+            self.traced('profile', self.fetch_user(access_token)),
+        )
+
+    def get_users_from_tokens(self, access_tokens):
+        """Retrieves the users of many access tokens.
+
+        Args:
+            access_tokens: a list of string access tokens, at most
+                BATCH_SIZE long to fit in a single vendor call.
+
+        Returns:
+            A list with a popular.users.User, or the SocialProviderError
+            the vendor sent, for every token.
+        """
+        return self.run(self.traced('profiles', self.profiles(access_tokens)))
+
+    def login(self, uri, state=None, verifier=None):
+        """Describes the requests that turn the response URI into a user.
+
+        Like every flow, this is a generator. Each vendor request is
+        yielded as a popular.transport.Request and its response is sent
+        back in, so the same flow runs on any transport. Requests that
+        don't depend on each other should be yielded together as a list;
+        they are sent concurrently and a list of responses comes back.
+
+        Args:
+            uri: a string uri that the service sent the user to,
+                including all query paramters attached.
+            state: a string that was provided for this exact request
+                when the user was first redirected, or None if it was
+                a signed state.
+
+        Returns:
+            A popular.users.User instance with its popular.tokens.Token,
+            through StopIteration.
+
+        Raises:
+            SocialError: The state parameter is invalid.
+            SocialError: The state parameter has expired.
+            SocialError: The authorization code was already used.
+        """
+        uri_params = self.parse_uri(uri, required=['code', 'state'])
+        claims = self.check_state(uri_params['state'], state)
+        if verifier is None and self.pkce:
+            if claims is None:
+                raise SocialError(_(
+                    "PKCE needs a code verifier or a signed state."
+                ))
+            verifier = self.signer.make_verifier(claims)
+        flow = self.authenticate(uri_params['code'], uri_params['state'],
+                                 verifier, claims)
+        if self.replay is not None:
+            flow = self.replay.coalesce(
+                self.replay.key(self.name, uri_params['code']), flow,
+            )
+        return (yield from flow)
+
+    def authenticate(self, code, state, verifier, claims):
+        """Describes the requests that trade a checked code for a user."""
+        token = yield from self.traced('exchange', self.exchange(
+            code, state, verifier,
+        ))
+        user = yield from self.traced('profile', self.token_user(token))
+        user.token = token
+        user.state = claims
+        return user
+
+    def check_state(self, received, expected):
+        """Makes sure the vendor sent back the state we sent it.
+
+        Without an expected state, the received one has to be a valid
+        signed state instead.
+
+        Returns:
+            The dict of claims of a signed state, or None.
+
+        Raises:
+            SocialError: The state parameter is invalid.
+            SocialError: The state parameter has expired.
+        """
+        if expected is None and self.signer is not None:
+            return self.signer.verify(received, self.name)
+        if received != expected:
+            raise SocialError(_("The state parameter is invalid."))
+        return None
+
+    def exchange(self, code, state, verifier=None):
+        """Describes the requests that trade a code for an access token.
+
+        By default this uses the standard OAuth authorization code grant
+        against TOKEN_URL.
+
+        Args:
+            code: the string authorization code from the response URI.
+            state: the string state of the request.
+            verifier: the string PKCE code verifier, if PKCE is used.
+
+        Returns:
+            A popular.tokens.Token instance, through StopIteration.
+        """
+        headers = {'Accept': 'application/json'}
+        data = dict(
+            client_id=self.config['client_id'],
+            client_secret=self.config['client_secret'],
+            redirect_uri=self.config['redirect_uri'],
+            code=code,
+            grant_type='authorization_code',
+        )
+        if verifier is not None:
+            data['code_verifier'] = verifier
+        url = yield from self.endpoint('token_endpoint', self.TOKEN_URL)
+        r = yield Request('POST', url, headers=headers, data=data)
+        return Token.from_response(self.response_to_dict(r))
+
+    def refresh(self, token):
+        """Describes the requests that trade a token for a fresh one.
+
+        By default this uses the standard OAuth refresh token grant
+        against TOKEN_URL. The refresh token is kept when the vendor
+        doesn't send a new one.
+
+        Args:
+            token: a popular.tokens.Token instance.
+
+        Returns:
+            A new popular.tokens.Token instance, through StopIteration.
+
+        Raises:
+            SocialError: The token can't be refreshed.
+        """
+        if not token.refresh_token:
+            raise SocialError(_("The token can't be refreshed."))
+        headers = {'Accept': 'application/json'}
+        data = dict(
+            client_id=self.config['client_id'],
+            client_secret=self.config['client_secret'],
+            refresh_token=token.refresh_token,
+            grant_type='refresh_token',
+        )
+        url = yield from self.endpoint('token_endpoint', self.TOKEN_URL)
+        r = yield Request('POST', url, headers=headers, data=data)
+        fresh = Token.from_response(self.response_to_dict(r))
+        if fresh.refresh_token is None:
+            fresh.refresh_token = token.refresh_token
+        return fresh
+
+    def refresh_token(self, token):
+        """Trades a token for a fresh one before it expires.
+
+        Args:
+            token: a popular.tokens.Token instance.
+
+        Returns:
+            A new popular.tokens.Token instance.
+
+        Raises:
+            SocialError: The token can't be refreshed.
+        """
+        return self.run(self.traced('refresh', self.refresh(token)))
+
+    async def refresh_token_async(self, token):
+        """Same as refresh_token, without blocking the event loop."""
+        return await self.run_async(
+            self.traced('refresh', self.refresh(token)),
+        )
+
+    def profile(self, access_token):
+        """Describes the requests that fetch the user of a token.
+
+        By default this is a single request to PROFILE_URL, asking only
+        for the fields that get mapped when the vendor can select them.
+
+        Args:
+            access_token: a string access token from the vendor.
+
+        Returns:
+            A popular.users.User instance, through StopIteration.
+        """
+        url = yield from self.endpoint('userinfo_endpoint', self.PROFILE_URL)
+        r = yield Request(
+            'GET', url,
+            headers=self.auth_headers(access_token),
+            params=self.profile_params,
+        )
+        return self.map_user(r, self.response_to_dict(r))
+
+    def auth_headers(self, access_token):
+        """Returns the headers of a request made on behalf of a user."""
+        return {
+            'Accept': 'application/json',
+            'Authorization': '%s %s' % (self.AUTH_SCHEME, access_token),
+        }
+
+    def map_user(self, response, raw):
+        """Builds the user from a decoded profile response."""
+        user = self.make_user(response, raw)
+        self.map_fields(user, raw)
+        return user
+
+    def profiles(self, access_tokens):
+        """Describes the requests that fetch the users of many tokens.
+
+        By default the tokens are fetched one after the other. Providers
+        with a vendor batch endpoint override this and BATCH_SIZE.
+
+        Returns:
+            A list with a popular.users.User, or the SocialProviderError
+            the vendor sent, for every token, through StopIteration.
+        """
+        users = []
+        for access_token in access_tokens:
+            try:
+                user = yield from self.fetch_user(access_token)
+            except SocialProviderError as err:
+                user = err
+            users.append(user)
+        return users
+
+    def token_user(self, token):
+        """Describes the requests that fetch the user a token was for.
+
+        By default the profile is fetched with the access token.
+        Providers whose token responses already describe the user
+        override this to skip that request.
+
+        Args:
+            token: a popular.tokens.Token instance.
+
+        Returns:
+            A popular.users.User instance, through StopIteration.
+        """
+        return self.fetch_user(token.access_token)
+
+    def discover(self):
+        """Describes the requests that get the vendor's discovery document.
+
+        Returns:
+            The decoded discovery document, or an empty dict when the
+            vendor has none, through StopIteration.
+        """
+        if self.DISCOVERY_URL is None:
+            return dict()
+        entry = yield from self.document(self.DISCOVERY_URL)
+        return entry['data']
+
+    def endpoint(self, name, default):
+        """Describes the requests that find one of the vendor's endpoints.
+
+        Args:
+            name: the key of the endpoint in the discovery document, like
+                `token_endpoint`.
+            default: the string URL to use when the vendor has no
+                discovery document, or it doesn't name the endpoint.
+
+        Returns:
+            The string URL of the endpoint, through StopIteration.
+        """
+        if self.DISCOVERY_URL is None:
+            return default
+        discovery = yield from self.discover()
+        return discovery.get(name) or default
+
+    def warm(self):
+        """Describes the requests that fetch the documents logins use.
+
+        Running this ahead of time means no login has to wait on them.
+        """
+        yield from self.discover()
+
+    def document(self, url, revalidate=False):
+        """Describes the requests that get a document the vendor publishes.
+
+        Cached documents are used without reaching out to the vendor.
+        Stale ones are revalidated in the background meanwhile.
+
+        Args:
+            url: the string URL of the document.
+            revalidate: whether to check with the vendor that a cached
+                document is current before using it.
+
+        Returns:
+            The entry of the document in the metadata cache, through
+            StopIteration.
+        """
+        entry = self.metadata.get(url)
+        if entry is None or revalidate:
+            r = yield self.metadata.request(url)
+            if r.status_code == 304 and entry is not None:
+                return self.metadata.load(url, r)
+            return self.metadata.load(url, r, self.response_to_dict(r))
+        if not self.metadata.is_fresh(entry):
+            self.metadata.revalidate(url, self.refresh_document)
+        return entry
+
+    def refresh_document(self, url):
+        """Fetches a document again now, for the metadata cache."""
+        return self.run(self.document(url, revalidate=True))
+
+    def fetch_user(self, access_token):
+        """Runs the profile flow through the cache, if there is one.
+
+        Only the mapped user attributes are cached, not the raw payload.
+        """
+        if self.cache is None:
+            user = yield from self.profile(access_token)
+            return user
+        key = self.cache_key(access_token)
+        cached = self.cache.get(key)
+        if cached is not None:
+            user = User()
+            user.map(**cached)
+            return user
+        user = yield from self.profile(access_token)
+        self.cache.set(key, user.to_dict())
+        return user
+
+    def cache_key(self, access_token):
+        """Builds the cache key of a token without storing the token."""
+        digest = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+        return 'popular:%s:user:%s' % (self.name, digest)
+
+    def traced(self, phase, flow):
+        """Wraps a flow to report it to the instrument as a phase.
+
+        Without an instrument the flow is returned untouched.
+        """
+        if self.instrument is None:
+            return flow
+        return self.trace(phase, flow)
+
+    def trace(self, phase, flow):
+        span = self.instrument.start(self.name, phase)
+        try:
+            result = yield from flow
+        except BaseException as err:
+            self.instrument.end(span, err)
+            raise
+        self.instrument.end(span)
+        return result
+
+    def run(self, flow):
+        """Drives a login flow over the blocking transport.
+
+        Errors sending a request are raised inside the flow, and a flow
+        left unfinished is closed, so flows can clean up after them.
+        """
+        deadline = self.start_deadline()
+        try:
+            request = next(flow)
+            while True:
+                try:
+                    if isinstance(request, Future):
+                        response = self.wait(request, deadline)
+                    else:
+                        response = self.send(request, deadline)
+                except Exception as err:
+                    request = flow.throw(err)
+                else:
+                    request = flow.send(response)
+        except StopIteration as stop:
+            return stop.value
+        except Exception as err:
+            if self.instrument is not None:
+                self.instrument.error(self.name, err)
+            raise
+        finally:
+            flow.close()
+
+    async def run_async(self, flow):
+        """Drives a login flow over the async transport."""
+        import asyncio
+        deadline = self.start_deadline()
+        try:
+            request = next(flow)
+            while True:
+                try:
+                    if isinstance(request, Future):
+                        response = await self.wait_async(request, deadline)
+                    else:
+                        response = await self.send_async(request, deadline)
+                except asyncio.CancelledError:
+                    # Not raised inside the flow, which is closed instead.
+                    raise
+                except Exception as err:
+                    request = flow.throw(err)
+                else:
+                    request = flow.send(response)
+        except StopIteration as stop:
+            return stop.value
+        except Exception as err:
+            if self.instrument is not None:
+                self.instrument.error(self.name, err)
+            raise
+        finally:
+            flow.close()
+
+    def wait(self, future, deadline=None):
+        """Waits for the result of a login running elsewhere.
+
+        Raises:
+            SocialTimeoutError: The vendor took too long to respond.
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            raise SocialTimeoutError(_("The vendor took too long to respond."))
+
+    async def wait_async(self, future, deadline=None):
+        """Same as wait, without blocking the event loop."""
+        import asyncio
+        # Shielded, so a waiter being cancelled leaves the login alone.
+        waiting = asyncio.shield(asyncio.wrap_future(future))
+        if deadline is None:
+            return await waiting
+        try:
+            return await asyncio.wait_for(
+                waiting, max(deadline - time.monotonic(), 0),
+            )
+        except asyncio.TimeoutError:
+            raise SocialTimeoutError(_("The vendor took too long to respond."))
+
+    def start_deadline(self):
+        """Returns the monotonic time a flow started now must end by."""
+        if self.deadline > 0:
+            return time.monotonic() + self.deadline
+        return None
+
+    def send(self, request, deadline=None):
+        """Sends a request, or a list of them, through the guard.
+
+        Idempotent requests that fail to connect or get a 429 or 5xx
+        response are retried with exponential jittered backoff, as long
+        as the deadline leaves time for it. Anything else, like trading
+        a code, is only ever sent once.
+
+        Args:
+            request: a popular.transport.Request, or a list of them to
+                send at the same time.
+            deadline: the monotonic time to give up at, or None.
+
+        Returns:
+            The response, or a list of them in the order of the requests.
+
+        Raises:
+            SocialRateLimitError: The vendor's rate limit is used up.
+            SocialTimeoutError: The vendor took too long to respond.
+            SocialProviderError: The vendor could not be reached.
+            SocialUnavailableError: The vendor is failing, try again
+                later.
+        """
+        batch = request if isinstance(request, list) else [request]
+        responses = [None] * len(batch)
+        pending = list(range(len(batch)))
+        attempt = 0
+        while True:
+            todo = [batch[i] for i in pending]
+            wait, trial = (
+                self.guard.before(len(todo)) if self.guard else (0, False)
+            )
+            try:
+                if wait:
+                    time.sleep(wait)
+                self.set_timeouts(todo, deadline)
+                if self.instrument is not None:
+                    started = self.before_send(todo)
+                try:
+                    if len(todo) == 1:
+                        sent = [self.transport.send(todo[0])]
+                    else:
+                        sent = self.transport.send_all(todo)
+                except Exception as err:
+                    if self.guard is not None:
+                        self.guard.failed()
+                    delay = self.retry_delay(attempt, todo, deadline)
+                    if delay is None:
+                        error = social_error(err)
+                        if error is err:
+                            raise
+                        raise error from err
+                else:
+                    if self.instrument is not None:
+                        self.after_send(todo, sent, started)
+                    pending = self.collect(pending, sent, batch, responses)
+                    delay = self.retry_delay(
+                        attempt, [batch[i] for i in pending], deadline,
+                    )
+                    if delay is None:
+                        break
+            finally:
+                # A trial that was made is already settled by now.
+                if trial:
+                    self.guard.abandon()
+            time.sleep(delay)
+            attempt += 1
+        return responses if batch is request else responses[0]
+
+    async def send_async(self, request, deadline=None):
+        """Same as send, over the async transport."""
+        import asyncio
+        batch = request if isinstance(request, list) else [request]
+        responses = [None] * len(batch)
+        pending = list(range(len(batch)))
+        attempt = 0
+        while True:
+            todo = [batch[i] for i in pending]
+            wait, trial = (
+                self.guard.before(len(todo)) if self.guard else (0, False)
+            )
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                self.set_timeouts(todo, deadline)
+                if self.instrument is not None:
+                    started = self.before_send(todo)
+                try:
+                    if len(todo) == 1:
+                        sent = [await self.async_transport.send(todo[0])]
+                    else:
+                        sent = await self.async_transport.send_all(todo)
+                except Exception as err:
+                    if self.guard is not None:
+                        self.guard.failed()
+                    delay = self.retry_delay(attempt, todo, deadline)
+                    if delay is None:
+                        error = social_error(err, (asyncio.TimeoutError,))
+                        if error is err:
+                            raise
+                        raise error from err
+                else:
+                    if self.instrument is not None:
+                        self.after_send(todo, sent, started)
+                    pending = self.collect(pending, sent, batch, responses)
+                    delay = self.retry_delay(
+                        attempt, [batch[i] for i in pending], deadline,
+                    )
+                    if delay is None:
+                        break
+            finally:
+                # A trial that was made is already settled by now.
+                if trial:
+                    self.guard.abandon()
+            await asyncio.sleep(delay)
+            attempt += 1
+        return responses if batch is request else responses[0]
+
+    def before_send(self, batch):
+        """Tells the instrument about requests about to be sent."""
+        for request in batch:
+            self.instrument.request(self.name, request)
+        return time.perf_counter()
+
+    def after_send(self, batch, responses, started):
+        """Tells the instrument about the responses to requests."""
+        seconds = time.perf_counter() - started
+        for request, response in zip(batch, responses):
+            self.instrument.response(self.name, request, response, seconds)
+
+    def set_timeouts(self, batch, deadline):
+        """Caps how long each request may take by what the deadline left.
+
+        Raises:
+            SocialTimeoutError: The vendor took too long to respond.
+        """
+        timeout = self.timeout
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise SocialTimeoutError(_(
+                    "The vendor took too long to respond."
+                ))
+            timeout = min(timeout, left)
+        for request in batch:
+            request.timeout = timeout
+
+    def collect(self, pending, sent, batch, responses):
+        """Stores the responses and returns the indexes to send again."""
+        retry = []
+        for index, response in zip(pending, sent):
+            responses[index] = response
+            if self.guard is not None:
+                self.guard.after(response)
+            failed = (
+                response.status_code == 429 or response.status_code >= 500
+            )
+            if failed and batch[index].idempotent:
+                retry.append(index)
+        return retry
+
+    def retry_delay(self, attempt, batch, deadline):
+        """Returns the seconds to back off before retrying, or None.
+
+        The backoff doubles with every attempt, and full jitter keeps
+        retries from many workers from arriving at the vendor together.
+        """
+        if not batch or attempt >= self.retries:
+            return None
+        if not all(request.idempotent for request in batch):
+            return None
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def response_to_dict(self, response):
+        """Decodes a vendor response, raising its errors.
+
+        Returns:
+            The decoded response body.
+
+        Raises:
+            SocialProviderError: The message sent by the vendor.
+        """
+        output = self.loads(response.content)
+        failed = response.status_code != 200
+        if isinstance(output, dict) and (failed or 'error' in output):
+            for path in self.ERROR_PATHS:
+                message = lookup(output, path.split('.'))
+                if isinstance(message, str):
+                    break
+            else:
+                message = output
+            failed = True
+        elif failed:
+            message = output
+        if failed:
+            err = SocialProviderError(message)
+            err.original = response
+            raise err
+        return output
+
+    def select_fields(self):
+        """Returns the value of the vendor's field selection parameter.
+
+        It is worked out once, as `selection`, when the provider is
+        made. By default this is a comma separated list of the top level
+        fields, which is what the Graph API expects.
+        """
+        return ','.join(self.fields)
+
+    def map_fields(self, user, raw):
+        """Maps the attributes in USER_FIELDS from a decoded profile."""
+        user.map(**{
+            attribute: lookup(raw, path)
+            for attribute, path in self.user_fields
+        })
+
+    def make_user(self, response, raw, fields=None):
+        """Starts a user from the vendor's profile response.
+
+        Args:
+            response: the response the profile was decoded from.
+            raw: the decoded profile.
+            fields: the top level fields of the profile the user is
+                mapped from, defaulting to the ones of USER_FIELDS.
+
+        Returns:
+            A popular.users.User instance holding the raw profile as
+            configured by the provider's raw option.
+        """
+        user = User()
+        if self.raw == RAW_KEEP:
+            user.set_raw(raw)
+        elif self.raw == RAW_BYTES:
+            user.set_raw(response.content)
+        elif self.raw == RAW_FIELDS:
+            user.set_raw(extract(raw, fields or self.fields))
+        return user
 
     def parse_uri(self, uri, required=None):
         """Parses the uri from the vendor.
 
-        This will make sure the required parameters are present.
+        This will make sure the required parameters are present, and
+        stops parsing once they have all been found.
 
         Args:
             uri: a string URI.
@@ -98,8 +1128,10 @@ class Provider(object):
         Raises:
             SocialError: Required query parameter \"%s\" is not
                 present.
+            SocialError: The query string is longer than %d characters.
+            SocialError: The query string has more than %d parameters.
         """
-        params = uri_to_query_string_params(uri)
+        params = parse_query_string(uri, required=required)
         for param in required:
             if param not in params:
                 raise SocialError(
@@ -110,3 +1142,9 @@ class Provider(object):
     def serialize_url(self, url, params):
         """Helper to add a query string to a url."""
         return '%s?%s' % (url, dict_to_query_string(params),)
+
+
+def spec_provider(spec):
+    """Makes a bare instance of a spec provider, for unpickling."""
+    cls = Provider.from_spec(spec)
+    return cls.__new__(cls)
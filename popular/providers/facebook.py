@@ -1,9 +1,12 @@
+from collections import OrderedDict
 from gettext import gettext as _
-import requests
+from urllib.parse import quote_plus
+import json
 
 from .base import Provider
-from ..exceptions import SocialError, SocialProviderError
-from ..users import User
+from ..exceptions import SocialProviderError
+from ..tokens import Token
+from ..transport import Request, Response
 
 
 class FacebookProvider(Provider):
@@ -11,99 +14,103 @@ class FacebookProvider(Provider):
 
     API_VERSION = 'v2.9'
 
+    # The Graph API answers up to 50 requests in a single batch.
+    BATCH_SIZE = 50
+
     CONFIG_KEYS = [
         'client_id',
         'client_secret',
         'redirect_uri',
     ]
 
-    def get_auth_url(self, state):
-        """Generates the url for the user to grant permission on.
+    AUTH_URL = 'https://www.facebook.com/%s/dialog/oauth' % API_VERSION
+
+    TOKEN_URL = 'https://graph.facebook.com/%s/oauth/access_token' % (
+        API_VERSION,
+    )
+
+    PROFILE_URL = 'https://graph.facebook.com/%s/me' % API_VERSION
+
+    SCOPES = ['public_profile', 'email']
+
+    SCOPE_SEPARATOR = ','
+
+    AUTH_SCHEME = 'OAuth'
+
+    FIELDS_PARAM = 'fields'
 
-        Args:
-            state: a string of random characters to help prevent CSRF
-                attacks.
+    # The avatar is made from the id instead.
+    USER_FIELDS = OrderedDict([
+        ('id', 'id'),
+        ('name', 'name'),
+        ('email', 'email'),
+    ])
 
-        Returns:
-            A string URL.
+    def refresh(self, token):
+        """Trades a token for a long-lived one.
+
+        Facebook has no refresh tokens, but a token that hasn't expired
+        yet can be exchanged for a new one lasting about 60 days.
         """
-        url = 'https://www.facebook.com/%s/dialog/oauth' % self.API_VERSION
-        return self.serialize_url(url=url, params=dict(
+        params = dict(
             client_id=self.config['client_id'],
-            redirect_uri=self.config['redirect_uri'],
-            state=state,
-            scope=','.join([
-                'public_profile',
-                'email',
-            ]),
-            response_type='code',
-        ))
-
-    def get_user(self, uri, state):
-        """Takes the response URI and retrieves a user from it.
-
-        Args:
-            uri: a string uri that the service sent the user to,
-                including all query paramters attached.
-            state: a string that was provided for this exact request
-                when the user was first redirected.
-
-        Returns:
-            A popular.users.User instance.
-
-        Raises:
-            The state parameter is invalid.
-        """
-        # See if the uri has what we expect.
-        uri_params = self.parse_uri(uri, required=['code', 'state'])
-        if uri_params['state'] != state:
-            raise SocialError(_("The state parameter is invalid."))
-
-        # Get the access token from the API.
-        url = 'https://graph.facebook.com/%s/oauth/access_token' % (
-            self.API_VERSION,
+            client_secret=self.config['client_secret'],
+            grant_type='fb_exchange_token',
+            fb_exchange_token=token.access_token,
         )
+        r = yield Request('GET', self.TOKEN_URL, params=params)
+        return Token.from_response(self.response_to_dict(r))
+
+    def profiles(self, access_tokens):
+        """Fetches up to BATCH_SIZE users with a single batch request."""
+        batch = []
+        for access_token in access_tokens:
+            batch.append(dict(
+                method='GET',
+                relative_url='%s/me?fields=%s&access_token=%s' % (
+                    self.API_VERSION,
+                    quote_plus(self.selection),
+                    quote_plus(access_token),
+                ),
+            ))
         data = dict(
-            client_id=self.config['client_id'],
-            client_secret=self.config['client_secret'],
-            redirect_uri=self.config['redirect_uri'],
-            code=uri_params['code'],
-            grant_type='authorization_code',
+            access_token='%s|%s' % (
+                self.config['client_id'],
+                self.config['client_secret'],
+            ),
+            batch=json.dumps(batch),
+            include_headers='false',
         )
-        r = requests.post(url, data=data)
-        access_token = self.response_to_dict(r)['access_token']
-
-        # Grab the user basics from the API.
-        url = 'https://graph.facebook.com/%s/me' % self.API_VERSION
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': 'OAuth %s' % access_token,
-        }
-        r = requests.get(url, headers=headers)
-        raw = self.response_to_dict(r)
-
-        # Get some extra info from the API.
-        url = 'https://graph.facebook.com/%s/%s' % (self.API_VERSION, raw['id'])
-        r = requests.get(url, headers=headers)
-        raw = self.response_to_dict(r)
-        user = User()
-        user.set_raw(raw)
-        user.map(
-            id=raw['id'],
-            name=raw['name'],
-            email=raw.get('email', None),
-            avatar='%s/picture' % url,
+        # Only reads are batched, so the batch is safe to send again.
+        r = yield Request(
+            'POST', 'https://graph.facebook.com', data=data, idempotent=True,
         )
-
+        users = []
+        for item in self.response_to_dict(r):
+            if item is None:
+                users.append(SocialProviderError(_(
+                    "Facebook did not answer this part of the batch."
+                )))
+                continue
+            response = Response(item['code'], item['body'].encode('utf-8'))
+            try:
+                users.append(self.map_user(
+                    response, self.response_to_dict(response),
+                ))
+            except SocialProviderError as err:
+                users.append(err)
+        return users
+
+    def map_user(self, response, raw):
+        """Builds the user from a decoded /me response."""
+        user = super().map_user(response, raw)
+        if 'avatar' in self.attributes:
+            user.map(avatar='https://graph.facebook.com/%s/%s/picture' % (
+                self.API_VERSION,
+                raw['id'],
+            ))
         return user
 
-    def response_to_dict(self, response):
-        """Helper to gracefully return error messages from API."""
-        output = response.json()
-        if response.status_code != 200 or 'error' in output:
-            raise SocialProviderError(output['error']['message'])
-        return output
-
 
 # Make a consistent reference for the Manager to use.
 provider = FacebookProvider
@@ -1,9 +1,10 @@
+from collections import OrderedDict
 from gettext import gettext as _
-import requests
 
 from .base import Provider
-from ..exceptions import SocialError, SocialProviderError
-from ..users import User
+from .. import oidc
+from ..exceptions import SocialProviderError
+from ..transport import Response
 
 
 class GoogleProvider(Provider):
@@ -15,96 +16,110 @@ class GoogleProvider(Provider):
         'redirect_uri',
     ]
 
-    def get_auth_url(self, state):
-        """Generates the url for the user to grant permission on.
+    # Set access_type to "offline" to also get a refresh token, and
+    # openid to "true" to build users from the ID token of the token
+    # response rather than fetching their profile.
+    OPTIONAL_CONFIG_KEYS = dict(
+        Provider.OPTIONAL_CONFIG_KEYS,
+        access_type='online',
+        openid='false',
+    )
 
-        Args:
-            state: a string of random characters to help prevent CSRF
-                attacks.
+    AUTH_URL = 'https://accounts.google.com/o/oauth2/v2/auth'
 
-        Returns:
-            A string URL.
+    # Used when the discovery document doesn't name the endpoints.
+    TOKEN_URL = 'https://oauth2.googleapis.com/token'
+
+    PROFILE_URL = 'https://openidconnect.googleapis.com/v1/userinfo'
+
+    SCOPES = [
+        'https://www.googleapis.com/auth/userinfo.email',
+        'https://www.googleapis.com/auth/userinfo.profile',
+    ]
+
+    # The userinfo endpoint has the same claims as the ID token, and
+    # can't leave any out.
+    USER_FIELDS = OrderedDict([
+        ('id', 'sub'),
+        ('name', 'name'),
+        ('email', 'email'),
+        ('avatar', 'picture'),
+    ])
+
+    ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+
+    DISCOVERY_URL = (
+        'https://accounts.google.com/.well-known/openid-configuration'
+    )
+
+    JWKS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+
+    def get_auth_params(self):
+        """Returns the static query parameters of the auth url."""
+        params = super().get_auth_params()
+        params['access_type'] = self.config['access_type']
+        if self.flag('openid'):
+            params['scope'] = 'openid %s' % params['scope']
+        # Google only hands out refresh tokens along with a consent.
+        if self.config['access_type'] == 'offline':
+            params['prompt'] = 'consent'
+        return params
+
+    def check_state(self, received, expected):
+        """Makes sure the vendor sent back the state we sent it, if any.
+
+        Raises:
+            SocialError: The state parameter is invalid.
+            SocialError: The state parameter has expired.
         """
-        url = 'https://accounts.google.com/o/oauth2/v2/auth'
-        return self.serialize_url(url=url, params=dict(
-            client_id=self.config['client_id'],
-            redirect_uri=self.config['redirect_uri'],
-            scope=' '.join([
-                'https://www.googleapis.com/auth/userinfo.email',
-                'https://www.googleapis.com/auth/userinfo.profile',
-            ]),
-            state=state,
-            access_type='online',
-            response_type='code',
-        ))
-
-    def get_user(self, uri, state):
-        """Takes the response URI and retrieves a user from it.
-
-        Args:
-            uri: a string uri that the service sent the user to,
-                including all query paramters attached.
-            state: a string that was provided for this exact request
-                when the user was first redirected.
-
-        Returns:
-            A popular.users.User instance.
+        if expected or (expected is None and self.signer is not None):
+            return super().check_state(received, expected)
+        return None
+
+    def token_user(self, token):
+        """Reads the user from the ID token when there is one."""
+        if token.id_token and self.flag('openid'):
+            return self.id_token_user(token.id_token)
+        return super().token_user(token)
+
+    def warm(self):
+        """Fetches the discovery document and keys for the ID token."""
+        yield from super().warm()
+        if self.flag('openid'):
+            url = yield from self.endpoint('jwks_uri', self.JWKS_URL)
+            yield from self.document(url)
+
+    def id_token_user(self, id_token):
+        """Verifies an ID token and builds the user it describes.
+
+        This only reaches out to Google when its discovery document or
+        signing keys aren't cached yet, or when the token is signed with
+        a key that isn't in the cached ones, as happens when Google
+        rolls its keys over.
 
         Raises:
-            The state parameter is invalid.
+            SocialProviderError: The ID token is malformed.
+            SocialProviderError: The ID token is invalid.
+            SocialProviderError: The ID token has expired.
         """
-        # See if the uri has what we expect.
-        uri_params = self.parse_uri(uri, required=['code', 'state'])
-        if state:
-            if uri_params['state'] != state:
-                raise SocialError(_("The state parameter is invalid."))
-
-        # Get the access token from the API.
-        url = 'https://www.googleapis.com/oauth2/v4/token'
-        data = dict(
-            client_id=self.config['client_id'],
-            client_secret=self.config['client_secret'],
-            redirect_uri=self.config['redirect_uri'],
-            code=uri_params['code'],
-            grant_type='authorization_code',
-        )
-        r = requests.post(url, data=data)
-        access_token = self.response_to_dict(r)['access_token']
-
-        # Grab the user from the API.
-        url = 'https://www.googleapis.com/plus/v1/people/me'
-        headers = {
-            'Accept': 'application/json',
-            'Authorization': 'Bearer %s' % access_token,
-        }
-        r = requests.get(url, headers=headers, params={'prettyPrint': 'false'})
-        raw = self.response_to_dict(r)
-        user = User()
-        user.set_raw(raw)
-        user.map(
-            id=raw['id'],
-            name=raw['displayName'],
-            email=raw['emails'][0]['value'],
-            avatar=raw['image']['url'],
+        header, claims, signed, signature = oidc.decode(id_token)
+        if header.get('alg') != 'RS256':
+            raise SocialProviderError(_("The ID token is invalid."))
+        url = yield from self.endpoint('jwks_uri', self.JWKS_URL)
+        entry = yield from self.document(url)
+        key = self.metadata.parse(url, entry, oidc.parse_keys).get(
+            header.get('kid'),
         )
-        return user
-
-    def response_to_dict(self, response):
-        """Helper to gracefully return error messages from API."""
-        output = response.json()
-        if response.status_code != 200:
-            if 'error' in output:
-                if 'message' in output['error']:
-                    err = SocialProviderError(output['error']['message'])
-                else:
-                    err = SocialProviderError(output['error'])
-            else:
-                err = SocialProviderError(output)
-            err.original = response
-            raise err
-
-
-        return output
+        if key is None:
+            entry = yield from self.document(url, revalidate=True)
+            key = self.metadata.parse(url, entry, oidc.parse_keys).get(
+                header.get('kid'),
+            )
+        if key is None or not oidc.verify_rs256(signed, signature, *key):
+            raise SocialProviderError(_("The ID token is invalid."))
+        oidc.verify_claims(claims, self.ISSUERS, self.config['client_id'])
+        payload = oidc.b64decode(signed.split(b'.')[1])
+        return self.map_user(Response(200, payload), claims)
 
 
 # Make a consistent reference for the Manager to use.
@@ -0,0 +1,44 @@
+"""Providers that need nothing beyond the standard flows.
+
+Each one is a spec: a dict of the lowercased Provider class attributes
+that set it apart, turned into a provider class by Provider.from_spec
+the first time it's used. The registry points at these dicts directly.
+"""
+
+from collections import OrderedDict
+
+
+gitlab = {
+    'name': 'gitlab',
+    'auth_url': 'https://gitlab.com/oauth/authorize',
+    'token_url': 'https://gitlab.com/oauth/token',
+    'profile_url': 'https://gitlab.com/api/v4/user',
+    'scopes': ['read_user'],
+    'user_fields': OrderedDict([
+        ('id', 'id'),
+        ('name', 'name'),
+        ('nickname', 'username'),
+        ('email', 'email'),
+        ('avatar', 'avatar_url'),
+    ]),
+}
+
+
+# Microsoft accounts, both personal and work or school ones, through
+# the Microsoft identity platform and Graph.
+microsoft = {
+    'name': 'microsoft',
+    'auth_url': (
+        'https://login.microsoftonline.com/common/oauth2/v2.0/authorize'
+    ),
+    'token_url': 'https://login.microsoftonline.com/common/oauth2/v2.0/token',
+    'profile_url': 'https://graph.microsoft.com/v1.0/me',
+    'scopes': ['User.Read'],
+    'fields_param': '$select',
+    'user_fields': OrderedDict([
+        ('id', 'id'),
+        ('name', 'displayName'),
+        ('nickname', 'userPrincipalName'),
+        ('email', 'mail'),
+    ]),
+}
@@ -1,9 +1,35 @@
+import asyncio
+import threading
+import time
+
 import pytest
 
 
+from . import registry
 from .facebook import FacebookProvider
 from .github import GithubProvider
 from .google import GoogleProvider
+from ..exceptions import SocialError, SocialProviderError, SocialTimeoutError
+from ..instrument import Instrument, OpenTelemetryInstrument
+from ..state import StateSigner
+from ..pkce import make_challenge, make_verifier
+from ..replay import ReplayStore
+from ..testing import (
+    VENDOR_ROUTES,
+    FakeAsyncTransport,
+    FakeTransport,
+    make_id_token,
+)
+from ..tokens import Token
+
+
+CONFIG = {
+    'client_id': 'moose',
+    'client_secret': 'moose',
+    'redirect_uri': 'https://moose.com/callback',
+}
+
+CALLBACK = 'https://moose.com/callback?code=abc&state=moose'
 
 
 def test_facebook_provider_auth_url_success():
@@ -31,3 +57,438 @@ def test_google_provider_auth_url_success():
         'redirect_uri': 'https://moose.com/callback',
     })
     url = provider.get_auth_url(state='moose')
+
+
+def test_provider_auth_url_precompiled():
+    provider = GithubProvider(CONFIG)
+    url = provider.get_auth_url(state='a b&c')
+    assert url.startswith('http://github.com/login/oauth/authorize?')
+    assert url.endswith('&state=a+b%26c')
+    assert 'client_id=moose' in url
+    provider.config = dict(CONFIG, client_id='elk')
+    assert 'client_id=elk' in provider.get_auth_url(state='moose')
+
+
+def test_provider_signed_state():
+    provider = GithubProvider(
+        CONFIG, transport=FakeTransport(), signer=StateSigner('moose'),
+    )
+    url = provider.get_auth_url(redirect='/home')
+    state = url.rpartition('&state=')[2]
+    user = provider.get_user('https://moose.com/callback?code=abc&state=%s'
+                             % state)
+    assert user.nickname == 'dreynolds'
+    assert user.state['redirect'] == '/home'
+    with pytest.raises(SocialError):
+        provider.get_user(CALLBACK)
+    with pytest.raises(SocialError):
+        GithubProvider(CONFIG).get_auth_url()
+
+
+def test_github_provider_get_user_success():
+    transport = FakeTransport()
+    provider = GithubProvider(CONFIG, transport=transport)
+    user = provider.get_user(uri=CALLBACK, state='moose')
+    assert user.to_dict() == {
+        'id': 1,
+        'name': 'Dennis Reynolds',
+        'nickname': 'dreynolds',
+        'email': 'dennis@example.com',
+        'avatar': 'https://example.com/dennis.png',
+    }
+    assert transport.sent[1].headers['Authorization'] == 'token github-token'
+
+
+def test_facebook_provider_get_user_success():
+    transport = FakeTransport()
+    provider = FacebookProvider(CONFIG, transport=transport)
+    user = provider.get_user(uri=CALLBACK, state='moose')
+    assert user.id == '2'
+    assert user.email == 'dennis@example.com'
+    assert len(transport.sent) == 2
+
+
+def test_google_provider_get_user_success():
+    transport = FakeTransport()
+    provider = GoogleProvider(CONFIG, transport=transport)
+    user = provider.get_user(uri=CALLBACK, state='moose')
+    assert user.id == '3'
+    assert user.name == 'Dennis Reynolds'
+    assert user.avatar == 'https://example.com/dennis.png'
+    assert [request.url for request in transport.sent] == [
+        GoogleProvider.DISCOVERY_URL,
+        'https://oauth2.googleapis.com/token',
+        'https://openidconnect.googleapis.com/v1/userinfo',
+    ]
+    # The endpoints come from the discovery document when it names them.
+    discovery = transport.routes[GoogleProvider.DISCOVERY_URL]
+    transport = FakeTransport(routes={
+        GoogleProvider.DISCOVERY_URL: dict(
+            discovery, userinfo_endpoint='https://moose.com/userinfo',
+        ),
+        'https://moose.com/userinfo': {'sub': '4'},
+    })
+    provider = GoogleProvider(CONFIG, transport=transport)
+    assert provider.get_user(uri=CALLBACK, state='moose').id == '4'
+    transport = FakeTransport(routes={GoogleProvider.DISCOVERY_URL: {}})
+    provider = GoogleProvider(CONFIG, transport=transport)
+    assert provider.get_user(uri=CALLBACK, state='moose').id == '3'
+    assert transport.sent[-1].url == GoogleProvider.PROFILE_URL
+
+
+def test_spec_providers_get_user_success():
+    for name in ('gitlab', 'microsoft'):
+        transport = FakeTransport()
+        provider = registry.get(name)(CONFIG, transport=transport)
+        assert provider.name == name
+        user = provider.get_user(uri=CALLBACK, state='moose')
+        assert user.name == 'Dennis Reynolds'
+        assert user.email == 'dennis@example.com'
+        exchange, profile = transport.sent
+        assert exchange.data['grant_type'] == 'authorization_code'
+        assert profile.headers['Authorization'] == 'Bearer %s-token' % name
+    selection = 'id,displayName,userPrincipalName,mail'
+    assert profile.params == {'$select': selection}
+
+
+def test_google_provider_id_token():
+    token_url = GoogleProvider.TOKEN_URL
+    claims = {
+        'iss': 'https://accounts.google.com',
+        'aud': 'moose',
+        'sub': '3',
+        'name': 'Dennis Reynolds',
+        'email': 'dennis@example.com',
+        'picture': 'https://example.com/dennis.png',
+        'iat': int(time.time()),
+        'exp': int(time.time()) + 3600,
+    }
+    id_token = make_id_token(claims)
+    transport = FakeTransport(routes={token_url: {
+        'access_token': 'google-token',
+        'expires_in': 3600,
+        'id_token': id_token,
+    }})
+    provider = GoogleProvider(
+        dict(CONFIG, openid='true'), transport=transport, raw='fields',
+    )
+    assert 'scope=openid+' in provider.get_auth_url('moose')
+    for i in range(2):
+        user = provider.get_user(uri=CALLBACK, state='moose')
+        assert user.id == '3'
+        assert user.email == 'dennis@example.com'
+        assert user.user['picture'] == 'https://example.com/dennis.png'
+    assert transport.counts == {
+        token_url: 2,
+        GoogleProvider.DISCOVERY_URL: 1,
+        'https://www.googleapis.com/oauth2/v3/certs': 1,
+    }
+    forged = id_token[:-8] + 'AAAAAAAA'
+    other = make_id_token(dict(claims, aud='elk'))
+    for bad in [forged, other, 'moose']:
+        transport = FakeTransport(routes={token_url: {
+            'access_token': 'google-token',
+            'id_token': bad,
+        }})
+        provider = GoogleProvider(
+            dict(CONFIG, openid='true'), transport=transport,
+        )
+        with pytest.raises(SocialProviderError):
+            provider.get_user(uri=CALLBACK, state='moose')
+
+
+def test_provider_pkce():
+    transport = FakeTransport()
+    provider = GithubProvider(
+        dict(CONFIG, pkce='true'), transport=transport,
+        signer=StateSigner('moose'),
+    )
+    url = provider.get_auth_url()
+    state = url.split('&state=')[1].split('&')[0]
+    challenge = url.split('&code_challenge=')[1].split('&')[0]
+    provider.get_user('https://moose.com/callback?code=abc&state=%s' % state)
+    verifier = transport.sent[0].data['code_verifier']
+    assert make_challenge(verifier) == challenge
+    with pytest.raises(SocialError):
+        provider.get_auth_url('moose')
+    verifier = make_verifier()
+    url = provider.get_auth_url('moose', verifier=verifier)
+    assert url.endswith('&code_challenge=%s&code_challenge_method=S256'
+                        % make_challenge(verifier))
+    provider.get_user(CALLBACK, 'moose', verifier)
+    assert transport.sent[-3].data['code_verifier'] == verifier
+
+
+def test_provider_attributes():
+    transport = FakeTransport()
+    provider = GithubProvider(
+        CONFIG, transport=transport, attributes=['nickname'],
+    )
+    user = provider.get_user_from_token('token')
+    assert (user.id, user.nickname, user.name) == (1, 'dreynolds', None)
+    assert list(transport.counts) == ['https://api.github.com/user']
+    provider = FacebookProvider(
+        CONFIG, transport=transport, attributes=['name'],
+    )
+    user = provider.get_user_from_token('token')
+    assert transport.sent[-1].params['fields'] == 'id,name'
+    assert user.avatar is None
+    provider = GoogleProvider(
+        CONFIG, transport=transport, attributes=['email'], raw='fields',
+    )
+    user = provider.get_user_from_token('token')
+    assert transport.sent[-1].params == {}
+    assert user.user == {'sub': '3', 'email': 'dennis@example.com'}
+    with pytest.raises(ValueError):
+        GithubProvider(CONFIG, attributes=['moose'])
+
+
+def test_provider_get_user_vendor_failure():
+    provider = GithubProvider(CONFIG, transport=FakeTransport(error_rate=1))
+    with pytest.raises(SocialProviderError) as err:
+        provider.get_user(uri=CALLBACK, state='moose')
+    assert str(err.value) == 'Injected vendor failure.'
+
+
+def test_provider_retries_only_idempotent_calls():
+    transport = FakeTransport(error_rate=1)
+    provider = GithubProvider(
+        dict(CONFIG, backoff='0'), transport=transport,
+    )
+    with pytest.raises(SocialProviderError):
+        provider.get_user(CALLBACK, 'moose')
+    assert transport.counts == {
+        'https://github.com/login/oauth/access_token': 1,
+    }
+    transport = FakeTransport(error_rate=1)
+    provider = GithubProvider(
+        dict(CONFIG, backoff='0'), transport=transport,
+    )
+    with pytest.raises(SocialProviderError):
+        provider.get_user_from_token('token')
+    assert transport.counts == {
+        'https://api.github.com/user': 3,
+        'https://api.github.com/user/emails': 3,
+    }
+
+
+def test_provider_deadline():
+    transport = FakeTransport(latency=0.05)
+    provider = GithubProvider(
+        dict(CONFIG, deadline='0.01'), transport=transport,
+    )
+    with pytest.raises(SocialTimeoutError):
+        provider.get_user(CALLBACK, 'moose')
+    assert transport.sent[0].timeout == pytest.approx(0.01, abs=0.005)
+    with pytest.raises(ValueError):
+        GithubProvider(dict(CONFIG, retries='many'))
+
+
+class Recorder(Instrument):
+
+    def __init__(self):
+        self.events = []
+
+    def start(self, provider, phase):
+        return phase
+
+    def end(self, span, error=None):
+        self.events.append(('end', span, error is None))
+
+    def response(self, provider, request, response, seconds):
+        self.events.append((request.url, len(response.content)))
+
+    def error(self, provider, error):
+        self.events.append(('error', error.__class__.__name__))
+
+
+def test_provider_instrument():
+    recorder = Recorder()
+    transport = FakeTransport()
+    provider = GithubProvider(CONFIG, transport=transport, instrument=recorder)
+    provider.get_user(CALLBACK, 'moose')
+    sizes = dict((url, len(body)) for url, body in transport.bodies.items())
+    token_url = 'https://github.com/login/oauth/access_token'
+    assert [e[:2] for e in recorder.events] == [
+        (token_url, sizes[token_url]),
+        ('end', 'exchange'),
+        ('https://api.github.com/user', sizes['https://api.github.com/user']),
+        ('https://api.github.com/user/emails',
+         sizes['https://api.github.com/user/emails']),
+        ('end', 'profile'),
+        ('end', 'login'),
+    ]
+    recorder.events = []
+    with pytest.raises(SocialError):
+        provider.get_user('https://moose.com/callback?state=moose', 'moose')
+    assert recorder.events == [
+        ('end', 'login', False),
+        ('error', 'SocialError'),
+    ]
+
+
+def test_opentelemetry_instrument_nests_spans():
+    sdk = pytest.importorskip('opentelemetry.sdk.trace')
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+
+    exporter = InMemorySpanExporter()
+    tracer_provider = sdk.TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracer = tracer_provider.get_tracer('tests')
+    provider = GithubProvider(
+        CONFIG, transport=FakeTransport(),
+        instrument=OpenTelemetryInstrument(tracer),
+    )
+    with tracer.start_as_current_span('app'):
+        provider.get_user(CALLBACK, 'moose')
+    spans = dict(
+        (span.context.span_id, span) for span in exporter.get_finished_spans()
+    )
+
+    def parent(span):
+        return spans[span.parent.span_id].name
+
+    names = dict()
+    for span in spans.values():
+        if span.name != 'app':
+            names.setdefault(span.name, set()).add(parent(span))
+    assert names == {
+        'popular.login': {'app'},
+        'popular.exchange': {'popular.login'},
+        'popular.profile': {'popular.login'},
+        'popular.request': {'popular.exchange', 'popular.profile'},
+    }
+
+
+def test_github_provider_get_user_async_success():
+    transport = FakeAsyncTransport(latency=0.01)
+    provider = GithubProvider(CONFIG, async_transport=transport)
+    loop = asyncio.new_event_loop()
+    try:
+        user = loop.run_until_complete(provider.get_user_async(
+            uri=CALLBACK,
+            state='moose',
+        ))
+    finally:
+        loop.close()
+    assert user.email == 'dennis@example.com'
+    assert len(transport.sent) == 3
+
+
+def test_provider_get_user_async_coalesced():
+    transport = FakeAsyncTransport(latency=0.01)
+    provider = GithubProvider(
+        CONFIG, async_transport=transport, replay=ReplayStore(),
+    )
+
+    async def login_twice():
+        return await asyncio.gather(
+            provider.get_user_async(uri=CALLBACK, state='moose'),
+            provider.get_user_async(uri=CALLBACK, state='moose'),
+        )
+
+    loop = asyncio.new_event_loop()
+    try:
+        first, second = loop.run_until_complete(login_twice())
+    finally:
+        loop.close()
+    assert first is second
+    assert len(transport.sent) == 3
+
+
+def test_provider_get_user_async_cancelled():
+    transport = FakeAsyncTransport(latency=0.05)
+    provider = GithubProvider(
+        CONFIG, async_transport=transport, replay=ReplayStore(),
+    )
+
+    async def cancel_login():
+        owner = asyncio.ensure_future(
+            provider.get_user_async(uri=CALLBACK, state='moose'),
+        )
+        await asyncio.sleep(0.01)
+        waiter = asyncio.ensure_future(
+            provider.get_user_async(uri=CALLBACK, state='moose'),
+        )
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        with pytest.raises(SocialError) as err:
+            await waiter
+        assert str(err.value) == 'The login was interrupted.'
+        return await provider.get_user_async(uri=CALLBACK, state='moose')
+
+    loop = asyncio.new_event_loop()
+    try:
+        user = loop.run_until_complete(cancel_login())
+    finally:
+        loop.close()
+    assert user.nickname == 'dreynolds'
+    assert provider.replay.stats()['size'] == 1
+
+
+def test_github_provider_fetches_profile_concurrently():
+    # Each profile request only gets its answer once both are in flight,
+    # and breaks the barrier if they are sent one after the other.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def together(url):
+        def route(request):
+            barrier.wait()
+            return VENDOR_ROUTES[url]
+        return route
+
+    transport = FakeTransport(routes={
+        url: together(url) for url in [
+            'https://api.github.com/user',
+            'https://api.github.com/user/emails',
+        ]
+    })
+    provider = GithubProvider(CONFIG, transport=transport)
+    user = provider.get_user(uri=CALLBACK, state='moose')
+    assert user.email == 'dennis@example.com'
+    assert not barrier.broken
+
+
+def test_provider_get_user_token():
+    provider = FacebookProvider(CONFIG, transport=FakeTransport())
+    user = provider.get_user(uri=CALLBACK, state='moose')
+    assert user.token.access_token == 'facebook-token'
+    assert user.token.expires_within(5184000)
+    assert not user.token.expires_within(60)
+
+
+def test_google_provider_offline_refresh():
+    transport = FakeTransport()
+    provider = GoogleProvider(
+        dict(CONFIG, access_type='offline'),
+        transport=transport,
+    )
+    url = provider.get_auth_url(state='moose')
+    assert 'access_type=offline' in url
+    assert 'prompt=consent' in url
+    token = Token('old', refresh_token='refresh', expires_at=0)
+    fresh = provider.refresh_token(token)
+    assert fresh.access_token == 'google-token'
+    assert fresh.refresh_token == 'refresh'
+    assert transport.sent[-1].url == 'https://oauth2.googleapis.com/token'
+    assert transport.sent[-1].data['grant_type'] == 'refresh_token'
+
+
+def test_facebook_provider_refresh():
+    transport = FakeTransport()
+    provider = FacebookProvider(CONFIG, transport=transport)
+    fresh = provider.refresh_token(Token('old', expires_at=0))
+    assert fresh.access_token == 'facebook-token'
+    assert transport.sent[0].params['fb_exchange_token'] == 'old'
+
+
+def test_github_provider_refresh_failure():
+    provider = GithubProvider(CONFIG, transport=FakeTransport())
+    with pytest.raises(SocialError) as err:
+        provider.refresh_token(Token('old'))
+    assert str(err.value) == "The token can't be refreshed."
@@ -0,0 +1,160 @@
+import heapq
+import itertools
+import threading
+import time
+
+from .forks import ProcessLocal
+
+
+class Refresher(ProcessLocal):
+    """Refreshes tracked tokens in batches before they expire.
+
+    Tokens are kept in a heap ordered by expiry, so each run only looks
+    at the ones that are due. Refreshing a bounded batch per interval
+    spreads the load on the vendors, and keeps refreshes off the request
+    path entirely.
+
+    The background thread doesn't survive a fork, so call `start` again
+    in the child process to keep refreshing there.
+    """
+
+    PROCESS_LOCAL = ('lock', 'stopped', 'thread')
+
+    def __init__(self, provider, window=300, batch_size=50, interval=30,
+                 retry_after=60, on_refresh=None, on_error=None):
+        """
+        Args:
+            provider: a callable returning the provider for the provider
+                key a token was tracked with, like Manager.provider.
+            window: how many seconds before expiry a token is refreshed.
+                A refreshed token is never due again within `interval`,
+                even when its lifetime is shorter than the window.
+            batch_size: the max number of tokens refreshed per run.
+            interval: the seconds between runs of the background thread.
+            retry_after: the seconds to wait before retrying a token that
+                failed to refresh.
+            on_refresh: called with the key and the new token after every
+                refresh, to store it.
+            on_error: called with the key, the token and the exception
+                when a refresh fails, or when on_refresh raises.
+        """
+        self.provider = provider
+        self.window = window
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_after = retry_after
+        self.on_refresh = on_refresh
+        self.on_error = on_error
+        self.tokens = dict()
+        self.heap = []
+        self.counter = itertools.count()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def track(self, key, provider_key, token):
+        """Starts refreshing a token ahead of its expiry.
+
+        Tokens that don't expire are ignored.
+
+        Args:
+            key: a hashable identifier of the account, like a user id.
+            provider_key: what to pass to the provider callable.
+            token: a popular.tokens.Token instance.
+        """
+        self.follow(key, provider_key, token, 0)
+
+    def follow(self, key, provider_key, token, earliest):
+        if token.expires_at is None:
+            self.untrack(key)
+            return
+        when = max(token.expires_at - self.window, earliest)
+        with self.lock:
+            self.tokens[key] = (provider_key, token)
+            self.schedule(key, token, when)
+
+    def untrack(self, key):
+        """Stops refreshing the token of an account."""
+        with self.lock:
+            self.tokens.pop(key, None)
+
+    def schedule(self, key, token, when):
+        # Callers must hold the lock. Superseded heap entries are skipped
+        # when they come up, rather than searched for and removed.
+        heapq.heappush(self.heap, (when, next(self.counter), key, token))
+
+    def due(self, now=None):
+        """Pops the batch of tracked tokens that need refreshing now.
+
+        Returns:
+            A list of (key, provider key, token) tuples.
+        """
+        now = time.time() if now is None else now
+        batch = []
+        with self.lock:
+            while self.heap and len(batch) < self.batch_size:
+                when, _count, key, token = self.heap[0]
+                if when > now:
+                    break
+                heapq.heappop(self.heap)
+                current = self.tokens.get(key)
+                if current is not None and current[1] is token:
+                    batch.append((key, current[0], token))
+        return batch
+
+    def run_once(self, now=None):
+        """Refreshes one batch of due tokens.
+
+        Returns:
+            The number of tokens refreshed.
+        """
+        refreshed = 0
+        for key, provider_key, token in self.due(now):
+            try:
+                fresh = self.provider(provider_key).refresh_token(token)
+            except Exception as err:
+                retry = time.time() + self.retry_after
+                with self.lock:
+                    if key in self.tokens:
+                        self.schedule(key, token, retry)
+                if self.on_error is not None:
+                    self.on_error(key, token, err)
+                continue
+            # A lifetime shorter than the window would make the fresh
+            # token due straight away, so it waits an interval at least.
+            self.follow(
+                key, provider_key, fresh, time.time() + self.interval,
+            )
+            refreshed += 1
+            if self.on_refresh is not None:
+                try:
+                    self.on_refresh(key, fresh)
+                except Exception as err:
+                    if self.on_error is not None:
+                        self.on_error(key, fresh, err)
+        return refreshed
+
+    def start(self):
+        """Runs batches in a background daemon thread until stopped."""
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            # Keep going straight away while full batches are due.
+            if self.run_once() < self.batch_size:
+                self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stops the background thread."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,174 @@
+"""Making authorization codes single-use before they reach the vendor.
+
+Users double-click, and proxies retry, so the same callback can arrive
+more than once. Vendors reject a code the second time it's traded, but
+only after a slow round trip. A ReplayStore remembers the codes it has
+seen for a while, so:
+
+- a callback arriving while the same one is still being exchanged waits
+  for that exchange and gets its user, instead of trading the code
+  again;
+- a callback arriving after its code was traded is rejected at once.
+
+Codes are kept as fixed-size digests in a bounded ring, oldest first, so
+memory stays flat however many logins go through it. States are made
+single-use by a popular.state.StateSigner given a replay cache.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from gettext import gettext as _
+import hashlib
+import threading
+import time
+
+from .exceptions import SocialError
+from .forks import ProcessLocal
+
+
+class ReplayStore(ProcessLocal):
+    """A bounded, time-windowed record of the codes being or already used.
+
+    Each entry maps the digest of a code to either the future of its
+    exchange in flight, or the time it can be forgotten once traded.
+    Exchanges that fail are forgotten right away, so the callback can be
+    tried again.
+    """
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, max_size=100000, window=600):
+        """
+        Args:
+            max_size: the max number of codes remembered. The oldest
+                ones are dropped first.
+            window: the seconds a traded code is rejected for. Vendors
+                expire their codes after a few minutes at most.
+        """
+        self.max_size = max_size
+        self.window = window
+        self.entries = OrderedDict()
+        self.coalesced = 0
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+        # Exchanges in flight in another process never finish here.
+        for key, (future, _expires) in list(self.entries.items()):
+            if future is not None:
+                del self.entries[key]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['entries'] = OrderedDict(
+            (key, entry) for key, entry in self.entries.items()
+            if entry[0] is None
+        )
+        return state
+
+    def key(self, provider, code):
+        """Returns the digest a code is remembered by."""
+        text = '%s:%s' % (provider, code)
+        return hashlib.sha256(text.encode('utf-8')).digest()[:16]
+
+    def claim(self, key):
+        """Marks a code as being exchanged, unless it already is.
+
+        Returns:
+            A tuple of the concurrent.futures.Future of the exchange and
+            whether the caller is the one to run it.
+
+        Raises:
+            SocialError: The authorization code was already used.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entries = self.entries
+            while entries:
+                future, expires = next(iter(entries.values()))
+                if future is not None or expires > now:
+                    break
+                entries.popitem(last=False)
+            entry = entries.get(key)
+            if entry is not None:
+                future, expires = entry
+                if future is not None:
+                    self.coalesced += 1
+                    return future, False
+                if expires > now:
+                    self.rejected += 1
+                    raise SocialError(
+                        _("The authorization code was already used.")
+                    )
+            future = Future()
+            entries[key] = (future, None)
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+        return future, True
+
+    def settle(self, key, future, result=None, error=None):
+        """Records how an exchange claimed with `claim` went.
+
+        Waiting callbacks get the same user, or the same error.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is future:
+                if error is None:
+                    self.entries[key] = (None, time.monotonic() + self.window)
+                    self.entries.move_to_end(key)
+                else:
+                    del self.entries[key]
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def coalesce(self, key, flow):
+        """Wraps a login flow so that its code is only traded once.
+
+        The wrapping flow yields the concurrent.futures.Future of the
+        login in flight when there is one, and the provider waits on it
+        rather than sending a request.
+
+        Args:
+            key: the digest of the code, from `key`.
+            flow: the flow trading the code for a user.
+
+        Returns:
+            The user of the login, shared with concurrent duplicates,
+            through StopIteration.
+
+        Raises:
+            SocialError: The authorization code was already used.
+            SocialError: The login was interrupted.
+        """
+        future, owner = self.claim(key)
+        if not owner:
+            return (yield future)
+        try:
+            result = yield from flow
+        except Exception as err:
+            self.settle(key, future, error=err)
+            raise
+        except BaseException:
+            # Cancelled, or the flow was closed before it finished.
+            self.settle(key, future, error=SocialError(
+                _("The login was interrupted.")
+            ))
+            raise
+        self.settle(key, future, result)
+        return result
+
+    def stats(self):
+        """Returns a dict of counters for monitoring."""
+        return dict(
+            coalesced=self.coalesced,
+            rejected=self.rejected,
+            size=len(self.entries),
+        )
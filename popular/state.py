@@ -0,0 +1,143 @@
+"""Signed, self-expiring `state` parameters.
+
+A signed state carries everything needed to check it: a random nonce,
+the provider it was issued for, where to send the user afterwards and
+when it expires, all under an HMAC. Nothing has to be saved to the
+visitor's session when they are sent to the vendor, or looked up when
+they come back.
+"""
+
+from gettext import gettext as _
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from .exceptions import SocialError
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode(text):
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+class StateSigner(object):
+    """Issues and verifies signed state parameters.
+
+    A state is only good for `ttl` seconds. With a replay cache, each
+    one is also only accepted once; without one, a state can be reused
+    until it expires, like a state kept in a session would be.
+    """
+
+    def __init__(self, secret, ttl=600, replay=None):
+        """
+        Args:
+            secret: the bytes or string key states are signed with. Keep
+                it secret, and the same across every process.
+            ttl: the number of seconds a state is valid for.
+            replay: a popular.cache.Cache remembering the states already
+                used, like a bounded popular.cache.MemoryCache, or a
+                popular.cache.SqliteCache shared between processes.
+        """
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.ttl = ttl
+        self.replay = replay
+
+    def sign(self, payload):
+        digest = hmac.new(self.secret, payload, hashlib.sha256).digest()
+        return encode(digest)
+
+    def issue(self, provider, redirect=None):
+        """Makes a new state.
+
+        Args:
+            provider: the string name of the provider it is for.
+            redirect: an optional string, like where to send the user
+                after logging in.
+
+        Returns:
+            A URL-safe string.
+        """
+        claims = dict(
+            n=encode(os.urandom(16)),
+            p=provider,
+            e=int(time.time()) + self.ttl,
+        )
+        if redirect is not None:
+            claims['r'] = redirect
+        payload = encode(
+            json.dumps(claims, separators=(',', ':')).encode('utf-8'),
+        )
+        return '%s.%s' % (payload, self.sign(payload.encode('ascii')))
+
+    def make_verifier(self, claims):
+        """Derives the PKCE code verifier of a signed state.
+
+        The verifier is an HMAC of the state's nonce, so it never has to
+        be stored, and can't be worked out from the state itself.
+
+        Args:
+            claims: the dict of claims of the state, from `verify`, or
+                the string state as it was issued.
+
+        Returns:
+            A string code verifier.
+        """
+        if isinstance(claims, str):
+            payload = claims.partition('.')[0]
+            nonce = json.loads(decode(payload).decode('utf-8'))['n']
+        else:
+            nonce = claims['nonce']
+        return self.sign(('pkce:%s' % nonce).encode('ascii'))
+
+    def verify(self, state, provider):
+        """Checks a state that a vendor sent back.
+
+        Args:
+            state: the string state from the response URI.
+            provider: the string name of the provider it came through.
+
+        Returns:
+            A dict with the `nonce`, `provider`, `redirect` and
+            `expires` of the state.
+
+        Raises:
+            SocialError: The state parameter is invalid.
+            SocialError: The state parameter has expired.
+        """
+        try:
+            state.encode('ascii')
+        except UnicodeEncodeError:
+            raise SocialError(_("The state parameter is invalid."))
+        payload, _dot, signature = state.partition('.')
+        expected = self.sign(payload.encode('ascii'))
+        if not hmac.compare_digest(expected, signature):
+            raise SocialError(_("The state parameter is invalid."))
+        try:
+            claims = json.loads(decode(payload).decode('utf-8'))
+        except (binascii.Error, ValueError):
+            raise SocialError(_("The state parameter is invalid."))
+        if claims['p'] != provider:
+            raise SocialError(_("The state parameter is invalid."))
+        left = claims['e'] - time.time()
+        if left <= 0:
+            raise SocialError(_("The state parameter has expired."))
+        if self.replay is not None:
+            key = 'popular:state:%s' % claims['n']
+            if not self.replay.add(key, 1, ttl=left):
+                raise SocialError(_("The state parameter is invalid."))
+        return dict(
+            nonce=claims['n'],
+            provider=claims['p'],
+            redirect=claims.get('r'),
+            expires=claims['e'],
+        )
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from gettext import gettext as _
+import threading
+
+from .exceptions import SocialError
+from .forks import ProcessLocal
+from .limits import CircuitBreaker, Guard, RateLimiter
+from .metadata import MetadataCache
+from .providers import registry
+from .transport import ExecutorAsyncTransport, HttpTransport
+
+
+# Only define error messages once.
+tenant_msg = _("The popular tenant %s does not exist.")
+configured_msg = _("The popular tenant %s has no %s provider.")
+
+
+class TenantManager(ProcessLocal):
+    """Manages providers for many tenants of the same vendors.
+
+    Each tenant has its own credentials for a vendor, but every tenant
+    shares the provider classes and the transport, so connections to a
+    vendor are pooled across all of them.
+
+    Credentials are kept in a table of tuples keyed by tenant and
+    provider, and are only validated once, when added. Provider
+    instances are built from them on demand and kept in a bounded LRU,
+    so memory stays flat no matter how many tenants are added.
+
+    Tenants of a vendor share its circuit breaker, since an outage hits
+    all of them, and its rate limiter, so a vendor's Retry-After
+    outlives the provider instances that are evicted.
+    """
+
+    PROCESS_LOCAL = ('lock',)
+
+    def __init__(self, transport=None, async_transport=None,
+                 max_providers=1024, breaker=None, metadata=None,
+                 **options):
+        """
+        Args:
+            transport: a popular.transport.Transport shared by every
+                tenant. A default one is made when omitted.
+            async_transport: an awaitable transport shared by every
+                tenant for get_user_async.
+            max_providers: the max number of provider instances kept
+                around at once.
+            breaker: a dict of popular.limits.CircuitBreaker arguments
+                used for every vendor.
+            metadata: a popular.metadata.MetadataCache shared by every
+                tenant for the documents the vendors publish.
+            **options: passed on to every provider, like raw='bytes'.
+        """
+        self.transport = transport
+        self.async_transport = async_transport
+        self.max_providers = max_providers
+        self.breaker = breaker or dict()
+        self.breakers = dict()
+        self.limiters = dict()
+        self.metadata = metadata if metadata is not None else MetadataCache()
+        self.options = options
+        self.credentials = dict()
+        self.instances = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def add(self, tenant, config):
+        """Adds or replaces the credentials of a tenant.
+
+        Args:
+            tenant: a hashable identifier of the tenant.
+            config: a dict representing all of the tenant's social
+                providers, in the same form the Manager accepts.
+
+        Raises:
+            SocialError: The popular provider "%s" does not exist.
+            SocialError: The %s provider requires the following
+                keys: %s.
+            ValueError: The popular configuration must be a dict.
+        """
+        if not isinstance(config, dict):
+            raise ValueError(_(
+                "The popular configuration must be a dict."
+            ))
+        rows = dict()
+        for name in config:
+            provider = registry.get(name)
+            provider.validate_config(config[name])
+            full = dict(provider.OPTIONAL_CONFIG_KEYS, **config[name])
+            rows[name] = tuple(full[key] for key in provider.config_keys())
+        with self.lock:
+            self.drop(tenant)
+            self.credentials[tenant] = rows
+
+    def remove(self, tenant):
+        """Forgets every credential of a tenant."""
+        with self.lock:
+            self.drop(tenant)
+
+    def drop(self, tenant):
+        # Callers must hold the lock.
+        for name in self.credentials.pop(tenant, ()):
+            self.instances.pop((tenant, name), None)
+
+    def provider(self, tenant, name):
+        """Returns the provider of a tenant.
+
+        Args:
+            tenant: a hashable identifier of the tenant.
+            name: a string name identifying the social provider.
+
+        Returns:
+            A subclass of popular.providers.base.Provider.
+
+        Raises:
+            SocialError: The popular tenant %s does not exist.
+            SocialError: The popular tenant %s has no %s provider.
+        """
+        key = (tenant, name)
+        with self.lock:
+            try:
+                instance = self.instances[key]
+            except KeyError:
+                pass
+            else:
+                self.instances.move_to_end(key)
+                return instance
+            if tenant not in self.credentials:
+                raise SocialError(tenant_msg % (tenant,))
+            try:
+                values = self.credentials[tenant][name]
+            except KeyError:
+                raise SocialError(configured_msg % (tenant, name))
+            if self.transport is None:
+                self.transport = HttpTransport()
+            if self.async_transport is None:
+                self.async_transport = ExecutorAsyncTransport(self.transport)
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(**self.breaker)
+                self.limiters[name] = RateLimiter()
+            guard = Guard(self.limiters[name], self.breakers[name])
+        # Building may import the provider, so other tenants aren't kept
+        # waiting on it.
+        provider = registry.get(name)
+        instance = provider(
+            dict(zip(provider.config_keys(), values)),
+            transport=self.transport,
+            async_transport=self.async_transport,
+            validate=False,
+            guard=guard,
+            metadata=self.metadata,
+            **self.options
+        )
+        with self.lock:
+            rows = self.credentials.get(tenant)
+            if rows is None or rows.get(name) is not values:
+                # The tenant changed meanwhile, so it isn't kept.
+                return instance
+            instance = self.instances.setdefault(key, instance)
+            self.instances.move_to_end(key)
+            if len(self.instances) > self.max_providers:
+                self.instances.popitem(last=False)
+            return instance
+
+    def health(self):
+        """Reports the circuit breaker state of every vendor used.
+
+        Returns:
+            A dict of provider names to dicts with their circuit `state`
+            and consecutive `failures`.
+        """
+        with self.lock:
+            return {
+                name: breaker.stats()
+                for name, breaker in self.breakers.items()
+            }
+
+    def close(self):
+        """Releases the pooled vendor connections."""
+        self.metadata.close()
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,259 @@
+"""Fakes for exercising the full login path without the real vendors.
+
+The FakeTransport replays canned token and profile responses shaped
+like the GitHub, Facebook and Google APIs, with configurable latency and
+error rates, so `get_user` can be tested, benchmarked and load tested
+offline.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+
+from .transport import Response, Transport
+
+
+# A throwaway RSA key standing in for Google's ID token signing key.
+TEST_KEY_ID = 'popular-test'
+TEST_KEY_N = int(
+    'c3386d1f80d0618c8f794bfe25528976ee99846bdfd64ceabb86d551f062f3fc'
+    '0c838abf57988c7f72fd6cebd3715772b56e35b59e587e56573bdb772bc97413'
+    'a47a481686e73ab84b4dc1d510f1cca3c88584dec484b20eba1eeb1bfae53acd'
+    'fb47921cb5f28efd32270ddabd40299f32858b1d41151772cb0f82da6ee7439d',
+    16,
+)
+TEST_KEY_E = 65537
+TEST_KEY_D = int(
+    '6e33f846046d9de3bf4a75ffae09fdd7c9b197f35d94982f1a556f2ea648f5fa'
+    '9f05d2d95915a09a81cb56257a634d3e4ff53b149fa2cd0ee887bdc8744b70de'
+    '79546e88ccb90db089aaa9740f32a9ed373a2950506ff2ad75db975b173e0370'
+    '483d5b6f4f7332de593f22b7628adefba38203e3cb8ec46d7e60754691af2a81',
+    16,
+)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def make_id_token(claims, kid=TEST_KEY_ID):
+    """Signs an ID token with the test key, like Google would."""
+    from .oidc import SHA256_PREFIX
+
+    header = {'alg': 'RS256', 'kid': kid, 'typ': 'JWT'}
+    signed = '%s.%s' % (
+        b64encode(json.dumps(header).encode('utf-8')),
+        b64encode(json.dumps(claims).encode('utf-8')),
+    )
+    size = (TEST_KEY_N.bit_length() + 7) // 8
+    digest = SHA256_PREFIX + hashlib.sha256(signed.encode('ascii')).digest()
+    padded = b'\x00\x01' + b'\xff' * (size - len(digest) - 3) + b'\x00'
+    message = int.from_bytes(padded + digest, 'big')
+    signature = pow(message, TEST_KEY_D, TEST_KEY_N).to_bytes(size, 'big')
+    return '%s.%s' % (signed, b64encode(signature))
+
+
+def facebook_batch(request):
+    """Answers every request of a Graph API batch with the /me profile."""
+    body = json.dumps(VENDOR_ROUTES['https://graph.facebook.com/v2.9/me'])
+    batch = json.loads(request.data['batch'])
+    return [{'code': 200, 'body': body} for item in batch]
+
+
+# Canned vendor responses, keyed by the request URL without a query.
+# Callables are given the request and return the body to send.
+VENDOR_ROUTES = {
+    'https://github.com/login/oauth/access_token': {
+        'access_token': 'github-token',
+        'token_type': 'bearer',
+        'scope': 'user:email',
+    },
+    'https://api.github.com/user': {
+        'id': 1,
+        'login': 'dreynolds',
+        'name': 'Dennis Reynolds',
+        'avatar_url': 'https://example.com/dennis.png',
+    },
+    'https://api.github.com/user/emails': [
+        {'email': 'golden@example.com', 'primary': False, 'verified': True},
+        {'email': 'dennis@example.com', 'primary': True, 'verified': True},
+    ],
+    'https://gitlab.com/oauth/token': {
+        'access_token': 'gitlab-token',
+        'token_type': 'Bearer',
+        'expires_in': 7200,
+        'refresh_token': 'gitlab-refresh',
+    },
+    'https://gitlab.com/api/v4/user': {
+        'id': 4,
+        'username': 'dreynolds',
+        'name': 'Dennis Reynolds',
+        'email': 'dennis@example.com',
+        'avatar_url': 'https://example.com/dennis.png',
+    },
+    'https://login.microsoftonline.com/common/oauth2/v2.0/token': {
+        'access_token': 'microsoft-token',
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+    },
+    'https://graph.microsoft.com/v1.0/me': {
+        'id': '5',
+        'displayName': 'Dennis Reynolds',
+        'userPrincipalName': 'dreynolds@example.com',
+        'mail': 'dennis@example.com',
+    },
+    'https://graph.facebook.com/v2.9/oauth/access_token': {
+        'access_token': 'facebook-token',
+        'token_type': 'bearer',
+        'expires_in': 5183944,
+    },
+    'https://graph.facebook.com': facebook_batch,
+    'https://graph.facebook.com/v2.9/me': {
+        'id': '2',
+        'name': 'Dennis Reynolds',
+        'email': 'dennis@example.com',
+    },
+    'https://oauth2.googleapis.com/token': {
+        'access_token': 'google-token',
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+    },
+    'https://accounts.google.com/.well-known/openid-configuration': {
+        'issuer': 'https://accounts.google.com',
+        'authorization_endpoint': (
+            'https://accounts.google.com/o/oauth2/v2/auth'
+        ),
+        'token_endpoint': 'https://oauth2.googleapis.com/token',
+        'userinfo_endpoint': (
+            'https://openidconnect.googleapis.com/v1/userinfo'
+        ),
+        'jwks_uri': 'https://www.googleapis.com/oauth2/v3/certs',
+        'id_token_signing_alg_values_supported': ['RS256'],
+    },
+    'https://www.googleapis.com/oauth2/v3/certs': {
+        'keys': [{
+            'kty': 'RSA',
+            'alg': 'RS256',
+            'use': 'sig',
+            'kid': TEST_KEY_ID,
+            'n': b64encode(TEST_KEY_N.to_bytes(128, 'big')),
+            'e': b64encode(TEST_KEY_E.to_bytes(3, 'big')),
+        }],
+    },
+    'https://openidconnect.googleapis.com/v1/userinfo': {
+        'sub': '3',
+        'name': 'Dennis Reynolds',
+        'email': 'dennis@example.com',
+        'email_verified': True,
+        'picture': 'https://example.com/dennis.png',
+    },
+}
+
+
+# Understood by the error handling of every bundled provider.
+ERROR_BODY = {
+    'message': 'Injected vendor failure.',
+    'error': {'message': 'Injected vendor failure.'},
+}
+
+
+class FakeTransport(Transport):
+    """Answers provider requests in-process with canned responses.
+
+    Unknown URLs get a 404 with a vendor-shaped error body. Every request
+    sent is recorded on `sent`, and `counts` tracks them by URL.
+    """
+
+    PROCESS_LOCAL = ('executor', 'lock')
+
+    def __init__(self, routes=None, latency=0, error_rate=0, seed=None,
+                 workers=10):
+        """
+        Args:
+            routes: a dict of URL to JSON-serializable body, or to a
+                callable building one from the request, merged over
+                VENDOR_ROUTES.
+            latency: the seconds every request takes, or a (low, high)
+                tuple to draw a uniformly random latency from.
+            error_rate: the fraction of requests, between 0 and 1, that
+                fail with a 500 response.
+            seed: makes the injected latency and errors repeatable.
+            workers: the max number of threads used to send independent
+                requests at the same time.
+        """
+        super().__init__(workers=workers)
+        self.routes = dict(VENDOR_ROUTES)
+        self.routes.update(routes or dict())
+        self.bodies = dict()
+        for url, body in self.routes.items():
+            if not callable(body):
+                self.bodies[url] = json.dumps(body).encode('utf-8')
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sent = []
+        self.counts = dict()
+        self.errors = 0
+
+    def reset(self):
+        super().reset()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """Picks how long the next request will take."""
+        if isinstance(self.latency, tuple):
+            with self.lock:
+                return self.random.uniform(*self.latency)
+        return self.latency
+
+    def respond(self, request):
+        """Builds the canned response for a request."""
+        with self.lock:
+            self.sent.append(request)
+            self.counts[request.url] = self.counts.get(request.url, 0) + 1
+            failed = (
+                self.error_rate and self.random.random() < self.error_rate
+            )
+            if failed:
+                self.errors += 1
+        headers = {'Content-Type': 'application/json'}
+        if failed:
+            body = json.dumps(ERROR_BODY).encode('utf-8')
+            return Response(500, body, headers)
+        if request.url in self.bodies:
+            return Response(200, self.bodies[request.url], headers)
+        if request.url in self.routes:
+            body = self.routes[request.url](request)
+            return Response(200, json.dumps(body).encode('utf-8'), headers)
+        body = json.dumps(ERROR_BODY).encode('utf-8')
+        return Response(404, body, headers)
+
+    def send(self, request):
+        seconds = self.delay()
+        if seconds:
+            time.sleep(seconds)
+        return self.respond(request)
+
+
+class FakeAsyncTransport(FakeTransport):
+    """The FakeTransport for get_user_async, sleeping on the event loop.
+
+    Latency is simulated with asyncio.sleep, so thousands of concurrent
+    fake logins don't need a thread each.
+    """
+
+    async def send(self, request):
+        seconds = self.delay()
+        if seconds:
+            await asyncio.sleep(seconds)
+        return self.respond(request)
+
+    async def send_all(self, batch):
+        return await asyncio.gather(*[self.send(r) for r in batch])
+
+    async def close(self):
+        super().close()
@@ -1,7 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
-from .exceptions import SocialError
+from .cache import MemoryCache, SqliteCache
+from .decoding import extract, get_loads
+from .exceptions import (
+    SocialError,
+    SocialProviderError,
+    SocialRateLimitError,
+    SocialTimeoutError,
+    SocialUnavailableError,
+)
 from . import Popular as Manager
+from . import loadtest
+from .forks import ProcessLocal, checked_getattribute
+from .limits import CircuitBreaker, Guard, RateLimiter
+from .metadata import MetadataCache
+from .providers import Registry, registry
+from .refresh import Refresher
+from .replay import ReplayStore
+from .state import StateSigner
+from .tenants import TenantManager
+from .testing import FakeTransport
+from .tokens import Token
+from .transport import HttpTransport, Request, Response
+from .users import RAW_BYTES, RAW_DROP, RAW_FIELDS, User
+from .utils import parse_query_string
 
 
 def test_manager_empty_success():
@@ -17,14 +48,15 @@ def test_manager_github_success():
     })
 
 def test_manager_github_failure():
+    manager = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            '0redirect_uri': 'moose',
+        },
+    })
     with pytest.raises(SocialError) as err:
-        Manager({
-            'github': {
-                'client_id': 'moose',
-                'client_secret': 'moose',
-                '0redirect_uri': 'moose',
-            },
-        })
+        manager.provider('github')
     assert str(err.value).startswith(
         'The github provider requires the following keys: '
     )
@@ -41,3 +73,755 @@ def test_manager_nonexistant_failure():
     with pytest.raises(SocialError) as err:
         Manager({'moose': {}})
     assert str(err.value) == 'The popular provider moose does not exist.'
+
+def test_manager_shares_transport():
+    transport = HttpTransport(pool_size=2, timeout=1)
+    manager = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport)
+    assert manager.provider('github').transport is transport
+    assert manager.provider('google').transport is transport
+    manager.close()
+
+def test_manager_provider_lazy():
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    })
+    assert manager.providers == {}
+    assert manager.provider('google') is manager.provider('google')
+    with pytest.raises(SocialError):
+        manager.provider('github')
+
+def test_registry_targets():
+    reg = Registry({'moose': 'popular.providers.github'})
+    assert 'moose' in reg
+    assert reg.get('moose').__name__ == 'GithubProvider'
+    reg.register('elk', 'popular.providers.google:GoogleProvider')
+    assert reg.get('elk').__name__ == 'GoogleProvider'
+    reg.register('bad', 'popular.providers.nothing')
+    with pytest.raises(SocialError) as err:
+        reg.get('bad')
+    assert str(err.value) == 'The popular provider bad does not exist.'
+    assert 'base' not in registry
+
+def test_registry_pkg_resources(monkeypatch):
+    class EntryPoint(object):
+        def __init__(self, name, module_name, attrs=()):
+            self.name = name
+            self.module_name = module_name
+            self.attrs = attrs
+
+    class PkgResources(object):
+        @staticmethod
+        def iter_entry_points(group):
+            assert group == 'popular.providers'
+            return [
+                EntryPoint('moose', 'moose_provider', ('MooseProvider',)),
+                EntryPoint('elk', 'elk_provider'),
+            ]
+
+    # As on Python 3.7 and older, with only setuptools to read them.
+    monkeypatch.setitem(sys.modules, 'importlib.metadata', None)
+    monkeypatch.setitem(sys.modules, 'pkg_resources', PkgResources)
+    reg = Registry({'elk': 'popular.providers.github'})
+    reg.discover()
+    assert reg.targets['moose'] == 'moose_provider:MooseProvider'
+    assert reg.targets['elk'] == 'popular.providers.github'
+    # Entry points can name attributes of attributes.
+    reg.register('owl', 'popular.providers.github:GithubProvider.__base__')
+    assert reg.get('owl').__name__ == 'Provider'
+
+def test_registry_specs():
+    reg = Registry()
+    reg.register('moose', {
+        'name': 'moose',
+        'auth_url': 'https://moose.com/authorize',
+        'token_url': 'https://moose.com/token',
+        'profile_url': 'https://moose.com/me',
+        'user_fields': {'id': 'sub'},
+    })
+    provider = reg.get('moose')
+    assert provider.__name__ == 'MooseProvider'
+    assert provider.PROFILE_URL == 'https://moose.com/me'
+    assert registry.get('gitlab').NAME == 'gitlab'
+    with pytest.raises(SocialError) as err:
+        registry.get('microsoft').validate_config({'client_id': 'moose'})
+    assert str(err.value).startswith('The microsoft provider requires')
+    with pytest.raises(ValueError) as err:
+        reg.register('elk', {'name': 'elk', 'antlers': 2})
+    assert str(err.value) == 'The provider spec has unknown keys: antlers.'
+
+def test_manager_pickle_spec_provider():
+    manager = Manager({
+        'gitlab': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=FakeTransport())
+    manager.preload()
+    gitlab = pickle.loads(pickle.dumps(manager)).provider('gitlab')
+    assert gitlab.name == 'gitlab'
+    user = gitlab.get_user_from_token('token')
+    assert user.nickname == 'dreynolds'
+
+def test_import_is_light():
+    code = 'import sys, popular; print("requests" in sys.modules)'
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.strip() == b'False'
+
+def test_tenant_manager_success():
+    transport = FakeTransport()
+    manager = TenantManager(transport=transport, max_providers=2)
+    for tenant in range(3):
+        manager.add(tenant, {
+            'github': {
+                'client_id': 'moose%d' % tenant,
+                'client_secret': 'moose',
+                'redirect_uri': 'moose',
+            },
+        })
+    github = manager.provider(1, 'github')
+    assert github.config['client_id'] == 'moose1'
+    assert github.transport is transport
+    assert manager.provider(1, 'github') is github
+    manager.provider(0, 'github')
+    manager.provider(2, 'github')
+    assert len(manager.instances) == 2
+    assert manager.provider(1, 'github') is not github
+    # Evicted instances come back with the vendor's rate limit intact.
+    assert manager.provider(0, 'github').guard.limiter is github.guard.limiter
+    manager.remove(1)
+    with pytest.raises(SocialError) as err:
+        manager.provider(1, 'github')
+    assert str(err.value) == 'The popular tenant 1 does not exist.'
+    with pytest.raises(SocialError) as err:
+        manager.provider(2, 'google')
+    assert str(err.value) == 'The popular tenant 2 has no google provider.'
+
+def test_tenant_manager_failure():
+    manager = TenantManager()
+    with pytest.raises(SocialError) as err:
+        manager.add('moose', {'github': {'client_id': 'moose'}})
+    assert str(err.value).startswith(
+        'The github provider requires the following keys: '
+    )
+    with pytest.raises(SocialError):
+        manager.add('moose', {'moose': {}})
+
+def test_parse_query_string_decoding():
+    params = parse_query_string(
+        'https://moose.com/cb?code=a%3Db=c&state=big+moose&flag&code=x#frag'
+    )
+    assert params == {'code': 'a=b=c', 'state': 'big moose', 'flag': True}
+
+def test_parse_query_string_stops_early():
+    uri = '/cb?state=moose&code=abc&%s' % ('&' * 5000)
+    params = parse_query_string(uri, required=['code', 'state'])
+    assert params == {'code': 'abc', 'state': 'moose'}
+
+def test_parse_query_string_limits():
+    with pytest.raises(SocialError) as err:
+        parse_query_string('/cb?code=%s' % ('a' * 100), max_length=50)
+    assert str(err.value) == 'The query string is longer than 50 characters.'
+    with pytest.raises(SocialError) as err:
+        parse_query_string('/cb?a&b&c&d', max_pairs=3)
+    assert str(err.value) == 'The query string has more than 3 parameters.'
+
+def test_user_slots():
+    user = User()
+    user.map(id=1, name='moose')
+    assert user.email is None
+    assert user.to_dict()['name'] == 'moose'
+    with pytest.raises(KeyError):
+        user.map(moose='moose')
+    with pytest.raises(AttributeError):
+        user.moose = 'moose'
+
+def test_user_raw_modes():
+    callback = 'https://moose.com/cb?code=abc&state=moose'
+    config = {
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }
+    manager = Manager(config, transport=FakeTransport())
+    user = manager.provider('github').get_user(uri=callback, state='moose')
+    assert user.user['login'] == 'dreynolds'
+    manager = Manager(config, transport=FakeTransport(), raw=RAW_BYTES)
+    user = manager.provider('github').get_user(uri=callback, state='moose')
+    assert isinstance(user.raw, bytes)
+    assert user.user['login'] == 'dreynolds'
+    manager = Manager(config, transport=FakeTransport(), raw=RAW_DROP)
+    user = manager.provider('github').get_user(uri=callback, state='moose')
+    assert user.user is None
+    manager = Manager(config, transport=FakeTransport(), raw=RAW_FIELDS)
+    user = manager.provider('github').get_user(uri=callback, state='moose')
+    assert sorted(user.user) == ['avatar_url', 'id', 'login', 'name']
+    with pytest.raises(ValueError):
+        Manager(config, raw='moose').provider('github')
+
+def test_json_backends():
+    assert get_loads('json')(b'{"a": [1]}') == {'a': [1]}
+    assert get_loads() is get_loads()
+    with pytest.raises(SocialError) as err:
+        get_loads('moose')
+    assert str(err.value) == 'The JSON backend moose is not available.'
+    assert extract({'a': 1, 'b': 2}, ['a', 'c']) == {'a': 1}
+
+def test_memory_cache_ttl_and_lru():
+    cache = MemoryCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=-1)
+    assert cache.get('b') is None
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'evictions': 1, 'size': 2}
+
+def test_sqlite_cache_shared(tmpdir):
+    path = str(tmpdir.join('cache.db'))
+    cache = SqliteCache(path, max_size=2)
+    cache.set('a', {'id': 1})
+    cache.set('b', {'id': 2})
+    cache.get('a')
+    cache.set('c', {'id': 3})
+    other = SqliteCache(path)
+    assert other.get('a') == {'id': 1}
+    assert other.get('b') is None
+    assert len(other) == 2
+    cache.close()
+    other.close()
+
+def test_sqlite_cache_bounded(tmpdir):
+    cache = SqliteCache(str(tmpdir.join('cache.db')), max_size=200)
+    for i in range(1000):
+        cache.set(str(i), i)
+    assert len(cache) <= 200 + cache.check_every
+    assert cache.stats()['evictions'] >= 800 - cache.check_every
+    assert cache.get('999') == 999
+    cache.close()
+
+def test_cache_counters_threads():
+    cache = MemoryCache()
+    cache.set('moose', 1)
+
+    def hit(_i):
+        for i in range(500):
+            cache.get('moose')
+            cache.get('elk')
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(hit, range(8)))
+    assert (cache.hits, cache.misses) == (4000, 4000)
+
+class DocumentTransport(FakeTransport):
+    """Serves a document with an ETag, and 304s when it's unchanged."""
+
+    def send(self, request):
+        self.sent.append(request)
+        if request.headers.get('If-None-Match') == '"v1"':
+            return Response(304, b'', {'Cache-Control': 'max-age=60'})
+        return Response(200, b'{"keys": []}', {
+            'ETag': '"v1"',
+            'Cache-Control': 'public, max-age=60',
+        })
+
+def test_metadata_cache(tmpdir):
+    store = SqliteCache(str(tmpdir.join('metadata.db')))
+    transport = DocumentTransport()
+    github = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport, metadata=MetadataCache(store)).provider('github')
+    url = 'https://moose.com/certs'
+    entry = github.run(github.document(url))
+    assert entry['data'] == {'keys': []}
+    assert github.run(github.document(url)) is entry
+    assert len(transport.sent) == 1
+    entry['expires'] = time.time() - 1
+    assert github.run(github.document(url)) is entry
+    github.metadata.close()
+    assert transport.sent[1].headers['If-None-Match'] == '"v1"'
+    fresh = github.metadata.get(url)
+    assert fresh['data'] is entry['data']
+    assert fresh['expires'] > time.time()
+    other = MetadataCache(store)
+    assert other.get(url)['data'] == {'keys': []}
+    store.close()
+    # Past `keep`, the stale document is fetched again before it's used.
+    github.metadata = MetadataCache(keep=60)
+    entry = github.run(github.document(url))
+    entry['expires'] = time.time() - 61
+    assert github.metadata.get(url) is None
+    entry = github.run(github.document(url))
+    assert entry['expires'] > time.time()
+    assert 'If-None-Match' not in transport.sent[-1].headers
+    assert github.metadata.executor is None
+
+def test_manager_preload_warm():
+    transport = FakeTransport()
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+            'openid': 'true',
+        },
+    }, transport=transport)
+    manager.preload(warm=True)
+    assert sorted(transport.counts) == [
+        'https://accounts.google.com/.well-known/openid-configuration',
+        'https://www.googleapis.com/oauth2/v3/certs',
+    ]
+    # Without openid, logins still need the discovery document for the
+    # token and userinfo endpoints, so warming fetches it too.
+    transport = FakeTransport()
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport)
+    manager.preload(warm=True)
+    assert list(transport.counts) == [
+        'https://accounts.google.com/.well-known/openid-configuration',
+    ]
+    manager.provider('google').get_user('/cb?code=abc&state=moose', 'moose')
+    assert transport.counts[
+        'https://accounts.google.com/.well-known/openid-configuration'
+    ] == 1
+
+def test_provider_cached_profile():
+    transport = FakeTransport()
+    cache = MemoryCache()
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport, cache=cache)
+    google = manager.provider('google')
+    user = google.get_user(uri='/cb?code=abc&state=moose', state='moose')
+    cached = google.get_user_from_token('google-token')
+    assert cached.to_dict() == user.to_dict()
+    # The discovery document, the token and the profile.
+    assert len(transport.sent) == 3
+    assert cache.hits == 1
+
+def test_refresher_batches():
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+            'access_type': 'offline',
+        },
+    }, transport=FakeTransport())
+    refreshed = dict()
+    refresher = Refresher(
+        manager.provider,
+        window=60,
+        batch_size=2,
+        on_refresh=refreshed.__setitem__,
+    )
+    now = time.time()
+    for user in range(3):
+        token = Token('old', refresh_token='r', expires_at=now + 30)
+        refresher.track(user, 'google', token)
+    refresher.track('later', 'google', Token('old', expires_at=now + 3600))
+    refresher.track('never', 'google', Token('old'))
+    assert refresher.run_once() == 2
+    assert refresher.run_once() == 1
+    assert refresher.run_once() == 0
+    assert sorted(refreshed) == [0, 1, 2]
+    assert refreshed[0].access_token == 'google-token'
+    assert refreshed[0].refresh_token == 'r'
+
+def test_refresher_window_and_callback_errors():
+    manager = Manager({
+        'google': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+            'access_type': 'offline',
+        },
+    }, transport=FakeTransport())
+    errors = []
+
+    def on_refresh(key, token):
+        raise ValueError(key)
+
+    # The window is longer than the hour the fresh tokens last.
+    refresher = Refresher(
+        manager.provider,
+        window=7200,
+        interval=30,
+        on_refresh=on_refresh,
+        on_error=lambda key, token, err: errors.append((key, err)),
+    )
+    token = Token('old', refresh_token='r', expires_at=time.time() + 30)
+    refresher.track('moose', 'google', token)
+    assert refresher.run_once() == 1
+    assert [(key, type(err)) for key, err in errors] == [
+        ('moose', ValueError),
+    ]
+    assert refresher.run_once() == 0
+    assert refresher.run_once(now=time.time() + 31) == 1
+
+def test_manager_fetch_users():
+    transport = FakeTransport()
+    manager = Manager({
+        'facebook': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport)
+    items = [(i, 'facebook', 'token%d' % i) for i in range(60)]
+    items += [('gh', 'github', 'token'), ('moose', 'moose', 'token')]
+    results = dict(
+        (r.key, r) for r in manager.fetch_users(iter(items), concurrency=3)
+    )
+    assert len(results) == 62
+    assert results[59].user.id == '2'
+    assert results['gh'].user.nickname == 'dreynolds'
+    assert isinstance(results['moose'].error, SocialError)
+    assert transport.counts['https://graph.facebook.com'] == 2
+
+def test_rate_limiter_headers():
+    limiter = RateLimiter(rate=1, burst=2, max_wait=0.5)
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+    with pytest.raises(SocialRateLimitError):
+        limiter.acquire()
+    limiter = RateLimiter()
+    headers = {
+        'x-ratelimit-remaining': '0',
+        'x-ratelimit-reset': str(int(time.time()) + 60),
+    }
+    # One user's token running out leaves the others alone.
+    limiter.update(Response(403, b'{}', headers))
+    assert limiter.acquire() == 0
+    limiter.update(Response(429, b'{}', headers))
+    with pytest.raises(SocialRateLimitError):
+        limiter.acquire()
+    limiter = RateLimiter()
+    limiter.update(Response(429, b'{}', {'Retry-After': '0'}))
+    assert limiter.acquire() == 0
+
+def test_circuit_breaker_states():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.failure()
+    breaker.allow()
+    breaker.failure()
+    assert breaker.stats()['state'] == 'open'
+    breaker.allow()
+    assert breaker.stats()['state'] == 'half_open'
+    with pytest.raises(SocialUnavailableError):
+        breaker.allow()
+    breaker.success()
+    assert breaker.stats() == {'state': 'closed', 'failures': 0}
+
+def test_guard_trial_always_settles():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    guard = Guard(RateLimiter(), breaker)
+    guard.after(Response(429, b'{}', {'Retry-After': '60'}))
+    assert breaker.stats()['state'] == 'open'
+    with pytest.raises(SocialRateLimitError):
+        guard.before()
+    assert breaker.stats()['state'] == 'open'
+    # The vendor's Retry-After runs out.
+    guard.limiter.blocked_until = 0
+    github = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=FakeTransport()).provider('github')
+    github.guard = guard
+    request = Request('GET', 'https://api.github.com/user')
+    with pytest.raises(SocialTimeoutError):
+        github.send(request, deadline=time.monotonic() - 1)
+    assert breaker.stats()['state'] == 'open'
+    assert github.send(request).status_code == 200
+    assert breaker.stats()['state'] == 'closed'
+    # Calls the open circuit turns away give their bucket tokens back.
+    limiter = RateLimiter(rate=1, burst=1)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.failure()
+    guard = Guard(limiter, breaker)
+    for i in range(3):
+        with pytest.raises(SocialUnavailableError):
+            guard.before()
+    assert limiter.bucket.tokens > 0.9
+
+def test_manager_breaker_fails_fast():
+    transport = FakeTransport(error_rate=1)
+    manager = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport, breaker={'failure_threshold': 2})
+    github = manager.provider('github')
+    for i in range(2):
+        with pytest.raises(SocialProviderError):
+            github.get_user_from_token('token')
+    with pytest.raises(SocialUnavailableError):
+        github.get_user_from_token('token')
+    assert transport.errors == 2
+    assert manager.health()['github']['state'] == 'open'
+
+def test_state_signer():
+    signer = StateSigner('moose', replay=MemoryCache(max_size=10))
+    state = signer.issue('github', redirect='/home')
+    claims = signer.verify(state, 'github')
+    assert claims['redirect'] == '/home'
+    assert claims['provider'] == 'github'
+    with pytest.raises(SocialError) as err:
+        signer.verify(state, 'github')
+    assert str(err.value) == 'The state parameter is invalid.'
+    state = signer.issue('github')
+    for bad in [state + 'x', 'x' + state, state.split('.')[0], 'moose']:
+        with pytest.raises(SocialError):
+            signer.verify(bad, 'github')
+    with pytest.raises(SocialError):
+        signer.verify(state, 'google')
+    with pytest.raises(SocialError):
+        StateSigner('elk').verify(state, 'github')
+    with pytest.raises(SocialError) as err:
+        signer.verify('\u00e9.\u00e9', 'github')
+    assert str(err.value) == 'The state parameter is invalid.'
+    with pytest.raises(SocialError) as err:
+        StateSigner('moose', ttl=-1).verify(
+            StateSigner('moose', ttl=-1).issue('github'), 'github',
+        )
+    assert str(err.value) == 'The state parameter has expired.'
+
+class RacingCache(MemoryCache):
+    """Holds each of two lookups until both have looked."""
+
+    def __init__(self):
+        super().__init__()
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def load(self, key, now):
+        value = super().load(key, now)
+        self.barrier.wait()
+        return value
+
+    def insert(self, key, value, expires, now):
+        self.barrier.wait()
+        return super().insert(key, value, expires, now)
+
+def test_state_signer_races(tmpdir):
+    for replay in [RacingCache(), SqliteCache(str(tmpdir.join('s.db')))]:
+        signer = StateSigner('moose', replay=replay)
+        state = signer.issue('github')
+
+        def verify(_i):
+            try:
+                return signer.verify(state, 'github')
+            except SocialError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(verify, range(2)))
+        assert sum(result is not None for result in results) == 1
+
+def test_manager_pickle():
+    manager = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=FakeTransport(), cache=MemoryCache())
+    manager.preload()
+    copy = pickle.loads(pickle.dumps(manager))
+    github = copy.provider('github')
+    assert github is not manager.provider('github')
+    assert github.transport is copy.transport
+    assert github.transport.executor is not manager.transport.executor
+    user = github.get_user('https://moose.com/cb?code=abc&state=moose',
+                           'moose')
+    assert user.nickname == 'dreynolds'
+
+def test_manager_fork():
+    manager = Manager({
+        'github': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=FakeTransport())
+    manager.preload()
+    executor = manager.transport.executor
+    manager.transport.send_all([Request('GET', 'https://moose.com')] * 2)
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            user = manager.provider('github').get_user_from_token('token')
+            ok = (
+                user.nickname == 'dreynolds'
+                and manager.transport.executor is not executor
+            )
+        finally:
+            os._exit(0 if ok else 1)
+    _pid, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+def test_process_local_pid_check(monkeypatch):
+    # As on Python 3.6 and older, without os.register_at_fork.
+    monkeypatch.setattr(
+        ProcessLocal, '__getattribute__', checked_getattribute,
+        raising=False,
+    )
+    cache = MemoryCache()
+    lock = cache.lock
+    assert cache.lock is lock
+    parent = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: parent + 1)
+    assert cache.pid == parent
+    assert cache.lock is not lock
+    assert cache.pid == parent + 1
+    cache.set('moose', 1)
+    assert cache.get('moose') == 1
+
+@pytest.mark.parametrize('mode', sorted(loadtest.MODES))
+def test_loadtest(mode):
+    report = loadtest.run(
+        'facebook', logins=20, concurrency=4, mode=mode, warmup=2,
+    )
+    assert report['failed'] == 0
+    assert report['p50'] <= report['p99']
+    assert report['throughput'] > 0
+    assert 'logins/s' in loadtest.format_report(report)
+
+def test_replay_store_coalesces_and_rejects():
+    transport = FakeTransport(latency=0.05)
+    manager = Manager({
+        'facebook': {
+            'client_id': 'moose',
+            'client_secret': 'moose',
+            'redirect_uri': 'moose',
+        },
+    }, transport=transport, replay=ReplayStore())
+    facebook = manager.provider('facebook')
+    uri = 'https://moose.com/cb?code=abc&state=moose'
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(facebook.get_user, uri, 'moose')
+            for i in range(3)
+        ]
+        forged = executor.submit(
+            facebook.get_user, uri.replace('moose', 'evil'), 'moose',
+        )
+        users = [future.result() for future in futures]
+        with pytest.raises(SocialError) as err:
+            forged.result()
+    assert str(err.value) == 'The state parameter is invalid.'
+    assert users[0] is users[1] is users[2]
+    token_url = 'https://graph.facebook.com/v2.9/oauth/access_token'
+    assert transport.counts[token_url] == 1
+    with pytest.raises(SocialError) as err:
+        facebook.get_user(uri, 'moose')
+    assert str(err.value) == 'The authorization code was already used.'
+    assert transport.counts[token_url] == 1
+    assert facebook.replay.stats() == {
+        'coalesced': 2, 'rejected': 1, 'size': 1,
+    }
+
+def test_replay_store_bounds():
+    replay = ReplayStore(max_size=2, window=60)
+    failed, owner = replay.claim(b'a')
+    replay.settle(b'a', failed, error=SocialError('moose'))
+    assert replay.claim(b'a')[1] is True
+    for key in (b'b', b'c'):
+        future, owner = replay.claim(key)
+        replay.settle(key, future, 'user')
+    assert len(replay.entries) == 2
+    assert replay.claim(b'a')[1] is True
+    with pytest.raises(SocialError):
+        replay.claim(b'c')
+    copy = pickle.loads(pickle.dumps(replay))
+    assert list(copy.entries) == [b'c']
+
+class RaisingTransport(FakeTransport):
+    """Fails every request with the exception it's given."""
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def send(self, request):
+        self.sent.append(request)
+        raise self.error
+
+def test_provider_maps_transport_errors():
+    config = {
+        'client_id': 'moose',
+        'client_secret': 'moose',
+        'redirect_uri': 'moose',
+        'retries': '0',
+    }
+    for error, expected in [
+        (socket.timeout('timed out'), SocialTimeoutError),
+        (ConnectionResetError('reset'), SocialProviderError),
+    ]:
+        github = Manager(
+            {'github': config}, transport=RaisingTransport(error),
+        ).provider('github')
+        with pytest.raises(expected) as err:
+            github.get_user_from_token('token')
+        assert err.value.__cause__ is error
+    github = Manager(
+        {'github': config}, transport=RaisingTransport(ValueError('bug')),
+    ).provider('github')
+    with pytest.raises(ValueError):
+        github.get_user_from_token('token')
+
+def test_http_transport_timeout():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    url = 'http://127.0.0.1:%d/' % server.getsockname()[1]
+    transport = HttpTransport(timeout=0.1)
+    try:
+        with pytest.raises(SocialTimeoutError) as err:
+            transport.send(Request('GET', url))
+        assert str(err.value) == 'The vendor took too long to respond.'
+    finally:
+        transport.close()
+        server.close()
@@ -0,0 +1,73 @@
+import time
+
+
+class Token(object):
+    """Credentials a vendor grants on behalf of a user.
+
+    Providers attach one to every user they log in as `user.token`, so
+    applications can store it and later refresh the token or the user's
+    profile without sending them through another redirect.
+    """
+
+    __slots__ = (
+        'access_token',
+        'refresh_token',
+        'expires_at',
+        'token_type',
+        'scope',
+        'id_token',
+    )
+
+    def __init__(self, access_token, refresh_token=None, expires_at=None,
+                 token_type=None, scope=None, id_token=None):
+        """
+        Args:
+            access_token: the string access token.
+            refresh_token: the string refresh token, if the vendor gave
+                one.
+            expires_at: the unix timestamp the access token expires at,
+                or None if it doesn't expire.
+            token_type: the string token type, like "bearer".
+            scope: the string scope that was granted.
+            id_token: the string OpenID Connect ID token, if the vendor
+                gave one.
+        """
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.token_type = token_type
+        self.scope = scope
+        self.id_token = id_token
+
+    @classmethod
+    def from_response(cls, data, now=None):
+        """Builds a token from a vendor's decoded token response."""
+        expires_at = None
+        if data.get('expires_in'):
+            now = time.time() if now is None else now
+            expires_at = now + int(data['expires_in'])
+        return cls(
+            access_token=data['access_token'],
+            refresh_token=data.get('refresh_token'),
+            expires_at=expires_at,
+            token_type=data.get('token_type'),
+            scope=data.get('scope'),
+            id_token=data.get('id_token'),
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        output = dict()
+        for a in self.__slots__:
+            output[a] = getattr(self, a)
+        return output
+
+    def expires_within(self, seconds, now=None):
+        """Whether the token expires in the next number of seconds."""
+        if self.expires_at is None:
+            return False
+        now = time.time() if now is None else now
+        return self.expires_at - now <= seconds
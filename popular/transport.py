@@ -0,0 +1,359 @@
+from gettext import gettext as _
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import socket
+
+from . import decoding
+from .exceptions import SocialError, SocialProviderError, SocialTimeoutError
+from .forks import ProcessLocal
+
+
+# Only define error messages once.
+timeout_msg = _("The vendor took too long to respond.")
+unreachable_msg = _("The vendor could not be reached.")
+
+
+def social_error(err, timeouts=()):
+    """Turns an error raised sending a request into a SocialError.
+
+    Args:
+        err: the exception a transport raised.
+        timeouts: more exception classes that mean a request timed out.
+
+    Returns:
+        A SocialTimeoutError for timeouts, a SocialProviderError for
+        other network errors, or else the exception itself.
+    """
+    if isinstance(err, SocialError):
+        return err
+    if isinstance(err, (TimeoutError, socket.timeout, FutureTimeoutError)
+                  + tuple(timeouts)):
+        return SocialTimeoutError(timeout_msg)
+    if isinstance(err, OSError):
+        return SocialProviderError(unreachable_msg)
+    return err
+
+
+class Request(object):
+    """A single request that a provider wants sent to its vendor.
+
+    Providers only describe their requests, which lets the same login
+    logic run over both the blocking and the asyncio transports.
+
+    Only idempotent requests are ever retried. GET requests are assumed
+    to be, and anything else has to say so.
+    """
+
+    def __init__(self, method, url, headers=None, params=None, data=None,
+                 idempotent=None, timeout=None):
+        """
+        Args:
+            method: a string HTTP method.
+            url: a string URL without a query string.
+            headers: a dict of request headers.
+            params: a dict of query parameters.
+            data: a dict of form fields for the body.
+            idempotent: whether sending the request twice is safe.
+                Defaults to True for GET requests only.
+            timeout: the seconds to wait on the vendor, or None for the
+                transport's default.
+        """
+        self.method = method
+        self.url = url
+        self.headers = headers or dict()
+        self.params = params
+        self.data = data
+        if idempotent is None:
+            idempotent = method == 'GET'
+        self.idempotent = idempotent
+        self.timeout = timeout
+
+
+class Response(object):
+    """A minimal response for transports that don't use requests.
+
+    It exposes the same `status_code`, `headers`, `content` and `json()`
+    members of a requests.Response that the providers rely on.
+    """
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or dict()
+
+    def json(self):
+        return decoding.loads(self.content)
+
+
+class Transport(ProcessLocal):
+    """Base class for sending provider requests to the vendors.
+
+    Subclasses only need to implement `send`. Passing an instance to the
+    Manager routes every provider through it, which is also the seam for
+    swapping in popular.testing.FakeTransport.
+
+    Transports can be pickled and survive forks: their worker threads
+    and connections are made again in each process.
+    """
+
+    PROCESS_LOCAL = ('executor',)
+
+    def __init__(self, workers=10):
+        """
+        Args:
+            workers: the max number of threads used to send independent
+                requests at the same time.
+        """
+        self.workers = workers
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def send(self, request):
+        """Sends a single request.
+
+        Args:
+            request: a popular.transport.Request instance.
+
+        Returns:
+            An object with `status_code`, `headers`, `content` and
+            `json()` like a requests.Response.
+        """
+        raise NotImplementedError()
+
+    def send_all(self, batch):
+        """Sends independent requests at the same time.
+
+        The first request is sent from the calling thread while the rest
+        go through the worker threads, so a login takes as long as its
+        slowest request rather than the sum of them all.
+
+        Args:
+            batch: a list of popular.transport.Request instances.
+
+        Returns:
+            A list of responses in the same order as the requests.
+        """
+        futures = [self.executor.submit(self.send, r) for r in batch[1:]]
+        responses = [self.send(batch[0])]
+        responses.extend(f.result() for f in futures)
+        return responses
+
+    def close(self):
+        """Releases any resources held by the transport."""
+        self.executor.shutdown(wait=False)
+
+
+class HttpTransport(Transport):
+    """Sends requests to the vendors over pooled connections.
+
+    A single transport keeps a connection pool per host, so repeated
+    logins against the same vendor reuse warm keep-alive connections
+    instead of paying for a new TCP and TLS handshake every time.
+
+    requests is only imported once a transport is made, which keeps
+    `import popular` itself light.
+    """
+
+    PROCESS_LOCAL = ('executor', 'requests', 'session')
+
+    def __init__(self, pool_size=10, pool_connections=10, max_retries=0,
+                 timeout=10, keep_alive=True, workers=None):
+        """Sets up the underlying connection pools.
+
+        Args:
+            pool_size: the max number of connections kept open per host.
+            pool_connections: the number of per-host pools to cache.
+            max_retries: how many times a failed connection attempt is
+                retried. Requests that reached the vendor are never
+                replayed.
+            timeout: the default number of seconds to wait on a vendor,
+                or None to wait forever.
+            keep_alive: whether connections are reused between requests.
+            workers: the max number of threads used to send independent
+                requests at the same time. Defaults to the pool size.
+        """
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.pool_connections = pool_connections
+        self.max_retries = max_retries
+        self.keep_alive = keep_alive
+        super().__init__(workers=workers or pool_size)
+
+    def reset(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        super().reset()
+        self.requests = requests
+        # A parent's pool is dropped rather than closed, since its
+        # sockets are still in use by the parent.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_size,
+            max_retries=self.max_retries,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if not self.keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def request(self, method, url, **kwargs):
+        """Sends a request through the pool.
+
+        Args:
+            method: a string HTTP method.
+            url: a string URL.
+            **kwargs: anything accepted by requests.Session.request.
+
+        Returns:
+            A requests.Response instance.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def send(self, request):
+        """Sends a popular.transport.Request through the pool.
+
+        Raises:
+            SocialTimeoutError: The vendor took too long to respond.
+            SocialProviderError: The vendor could not be reached.
+        """
+        try:
+            return self.request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                params=request.params,
+                data=request.data,
+                timeout=request.timeout or self.timeout,
+            )
+        except self.requests.Timeout as err:
+            raise SocialTimeoutError(timeout_msg) from err
+        except self.requests.RequestException as err:
+            raise SocialProviderError(unreachable_msg) from err
+
+    def close(self):
+        """Closes every pooled connection."""
+        self.session.close()
+        super().close()
+
+
+class ExecutorAsyncTransport(ProcessLocal):
+    """Awaitable wrapper that runs a blocking transport in an executor.
+
+    This is the fallback when no native asyncio HTTP client is
+    available. It keeps the event loop free, at the cost of a thread per
+    in-flight request.
+    """
+
+    PROCESS_LOCAL = ('executor',)
+
+    def __init__(self, transport, executor=None):
+        """
+        Args:
+            transport: a popular.transport.Transport instance.
+            executor: a concurrent.futures.Executor, or None to use the
+                event loop's default one. Pickles and forked children
+                fall back to the default one.
+        """
+        self.transport = transport
+        self.reset()
+        self.executor = executor
+
+    def reset(self):
+        super().reset()
+        self.executor = None
+
+    async def send(self, request):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, self.transport.send, request,
+        )
+
+    async def send_all(self, batch):
+        import asyncio
+        return await asyncio.gather(*[self.send(r) for r in batch])
+
+    async def close(self):
+        pass
+
+
+class AiohttpTransport(ProcessLocal):
+    """Native asyncio transport backed by aiohttp.
+
+    Thousands of logins can be in flight on one event loop without a
+    thread each. aiohttp is an optional dependency and is only imported
+    when this transport is created.
+    """
+
+    PROCESS_LOCAL = ('aiohttp', 'session')
+
+    def __init__(self, pool_size=100, timeout=10):
+        """
+        Args:
+            pool_size: the max number of connections kept open per host.
+            timeout: the total number of seconds to wait on a vendor.
+
+        Raises:
+            SocialError: The aiohttp package is required for the
+                AiohttpTransport.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        try:
+            import aiohttp
+        except ImportError:
+            raise SocialError(_(
+                "The aiohttp package is required for the AiohttpTransport."
+            ))
+        super().reset()
+        self.aiohttp = aiohttp
+        self.session = None
+
+    async def send(self, request):
+        import asyncio
+        # Sessions are bound to the running loop, so make it on demand.
+        if self.session is None:
+            self.session = self.aiohttp.ClientSession(
+                connector=self.aiohttp.TCPConnector(
+                    limit_per_host=self.pool_size,
+                ),
+                timeout=self.aiohttp.ClientTimeout(total=self.timeout),
+            )
+        options = dict()
+        if request.timeout is not None:
+            options['timeout'] = self.aiohttp.ClientTimeout(
+                total=request.timeout,
+            )
+        try:
+            async with self.session.request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                params=request.params,
+                data=request.data,
+                **options
+            ) as r:
+                content = await r.read()
+                return Response(r.status, content, dict(r.headers))
+        except asyncio.TimeoutError as err:
+            raise SocialTimeoutError(timeout_msg) from err
+        except self.aiohttp.ClientError as err:
+            raise SocialProviderError(unreachable_msg) from err
+
+    async def send_all(self, batch):
+        import asyncio
+        return await asyncio.gather(*[self.send(r) for r in batch])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -1,3 +1,12 @@
+from . import decoding
+
+
+# How a provider holds on to the vendor's original user payload.
+RAW_KEEP = 'keep'
+RAW_BYTES = 'bytes'
+RAW_DROP = 'drop'
+RAW_FIELDS = 'fields'
+RAW_MODES = (RAW_KEEP, RAW_BYTES, RAW_DROP, RAW_FIELDS)
 
 
 class User(object):
@@ -6,6 +15,9 @@ class User(object):
     Providers return different forms of information. This container is
     meant to provide a common interface with that information across all
     vendors.
+
+    Users have a fixed layout, so many of them can be held at once
+    cheaply.
     """
 
     ATTRIBUTES = [
@@ -16,9 +28,21 @@ class User(object):
         'avatar',
     ]
 
+    ATTRIBUTE_SET = frozenset(ATTRIBUTES)
+
+    __slots__ = tuple(ATTRIBUTES) + ('raw', 'token', 'state')
+
+    def __init__(self):
+        self.id = None
+        self.name = None
+        self.nickname = None
+        self.email = None
+        self.avatar = None
+        self.raw = None
+        self.token = None
+        self.state = None
+
     def __getattr__(self, key):
-        if key in self.ATTRIBUTES:
-            return None
         raise AttributeError("The attribute \"%s\" does not exist." % key)
 
     def map(self, **kwargs):
@@ -32,13 +56,29 @@ class User(object):
             KeyError: Cannot map attribute "%s" to user.
         """
         for name in kwargs:
-            if name not in self.ATTRIBUTES:
+            if name not in self.ATTRIBUTE_SET:
                 raise KeyError("Cannot map attribute \"%s\" to user." % name)
             setattr(self, name, kwargs[name])
 
     def set_raw(self, user):
-        """Saves the original data here."""
-        self.user = user
+        """Saves the original data here.
+
+        Args:
+            user: the decoded vendor payload, or the undecoded JSON bytes
+                to only decode when `user` is read.
+        """
+        self.raw = user
+
+    @property
+    def user(self):
+        """The original data from the vendor, or None if it was dropped.
+
+        Undecoded payloads are decoded on every access rather than kept
+        around in both forms.
+        """
+        if isinstance(self.raw, bytes):
+            return decoding.loads(self.raw)
+        return self.raw
 
     def to_dict(self):
         output = dict()
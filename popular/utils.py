@@ -1,4 +1,12 @@
-from urllib.parse import quote_plus, unquote
+from gettext import gettext as _
+from urllib.parse import quote_plus, unquote_plus
+
+from .exceptions import SocialError
+
+
+# Bounds the work done on a callback uri, which anyone can send.
+MAX_QUERY_LENGTH = 8192
+MAX_QUERY_PAIRS = 128
 
 
 def dict_to_query_string(d):
@@ -18,15 +26,97 @@ def uri_to_query_string_params(uri):
     Args:
         uri: expects a uri that starts with https?:// or /.
     """
+    return parse_query_string(uri)
+
+
+def parse_query_string(uri, required=None, max_length=MAX_QUERY_LENGTH,
+                       max_pairs=MAX_QUERY_PAIRS):
+    """Parses the query string of a uri in a single pass.
+
+    Values are decoded like application/x-www-form-urlencoded, so `+` is
+    a space and only the first `=` of a pair separates its key from its
+    value. Parameters without any `=` are set to True. When a parameter
+    repeats, its first value wins.
+
+    Args:
+        uri: expects a uri that starts with https?:// or /.
+        required: a list of parameter names. Parsing stops as soon as
+            they have all been found, so the rest of the query string is
+            never looked at.
+        max_length: the max number of characters in the query string.
+        max_pairs: the max number of parameters parsed.
+
+    Returns:
+        A dict of parsed query parameters.
+
+    Raises:
+        SocialError: The query string is longer than %d characters.
+        SocialError: The query string has more than %d parameters.
+    """
     output = dict()
-    if '?' not in uri:
+    start = uri.find('?') + 1
+    if not start:
         return output
-    qs = uri[uri.find('?')+1:].split('#')[0]
-    pairs = qs.split('&')
-    for pair in pairs:
-        if '=' not in pair:
-            output[unquote(pair)] = True
-            continue
-        elems = pair.split('=')
-        output[unquote(elems[0])] = unquote(elems[1])
+    end = uri.find('#', start)
+    if end == -1:
+        end = len(uri)
+    if end - start > max_length:
+        raise SocialError(
+            _("The query string is longer than %d characters.") % max_length
+        )
+    missing = set(required) if required else None
+    pairs = 0
+    while start < end:
+        stop = uri.find('&', start, end)
+        if stop == -1:
+            stop = end
+        if stop > start:
+            pairs += 1
+            if pairs > max_pairs:
+                raise SocialError(
+                    _("The query string has more than %d parameters.")
+                    % max_pairs
+                )
+            sep = uri.find('=', start, stop)
+            if sep == -1:
+                name = decode(uri[start:stop])
+                value = True
+            else:
+                name = decode(uri[start:sep])
+                value = decode(uri[sep + 1:stop])
+            if name not in output:
+                output[name] = value
+            if missing is not None:
+                missing.discard(name)
+                if not missing:
+                    break
+        start = stop + 1
     return output
+
+
+def decode(s):
+    """Unquotes a query string component, skipping the work if unneeded."""
+    if '%' in s or '+' in s:
+        return unquote_plus(s)
+    return s
+
+
+def lookup(data, path):
+    """Follows a path of keys and list indexes into decoded JSON.
+
+    Args:
+        data: decoded JSON.
+        path: a list of string keys, where digits index into lists.
+
+    Returns:
+        The value at the end of the path, or None if it isn't there.
+    """
+    for key in path:
+        try:
+            if isinstance(data, list):
+                data = data[int(key)]
+            else:
+                data = data[key]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+    return data